@@ -30,5 +30,11 @@ class OTP(models.Model):
     otp = models.CharField(max_length=6)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['phone_number', 'otp', 'created_at'], name='auth_otp_lookup_idx'),
+        ]
+
     def __str__(self):
         return str(self.phone_number) + ' - ' + self.otp
@@ -5,6 +5,8 @@ from . import serializers
 
 from django.conf import settings
 
+from ecom.carts import GUEST_CART_COOKIE, ensure_cart, merge_guest_cart
+
 from rest_framework import status
 from rest_framework.viewsets import ViewSet
 from rest_framework.response import Response
@@ -28,13 +30,19 @@ class LogInViewSet(ViewSet):
             user, created = models.User.objects.get_or_create(
                 phone_number=phone_number)
 
+            ensure_cart(user)
+            merged = merge_guest_cart(request, user)
+
             refresh = RefreshToken.for_user(user)
 
-            return Response({
+            response = Response({
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
                 'new_user': created
             }, status=status.HTTP_200_OK)
+            if merged:
+                response.delete_cookie(GUEST_CART_COOKIE)
+            return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
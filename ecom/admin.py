@@ -1,6 +1,14 @@
 from typing import Any
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, F, FloatField, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.http.request import HttpRequest
+from django.utils.functional import cached_property
+from . import carts
+from . import orders
 from . import models
 from . import forms
 from . import filters
@@ -8,6 +16,71 @@ from . import filters
 # Register your models here.
 
 
+def get_estimated_count_threshold():
+    return getattr(settings, 'ECOM_ADMIN_ESTIMATED_COUNT_THRESHOLD', 10000)
+
+
+def estimated_count(model, using):
+    '''
+    The number of rows of the table of model according to the statistics
+    of the database, or None where there are none to read.
+    '''
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Counts the rows of an unfiltered changelist from the table statistics
+    instead of with a COUNT(*) over the whole table, once it holds more
+    than ECOM_ADMIN_ESTIMATED_COUNT_THRESHOLD rows (10000 by default).
+    Filtered changelists are counted.
+    '''
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > get_estimated_count_threshold():
+                return estimate
+        return super().count
+
+
+class ScalableChangeListMixin:
+    '''
+    For the changelists of large tables: no count of the whole table next to
+    the filtered count, and an estimated count when nothing is filtered.
+    '''
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+
+
+def related_aggregate(queryset, field, aggregate, output_field):
+    '''
+    The aggregate of the rows of queryset pointing to the outer row through
+    field, as a subquery, 0 when there are none. Unlike an aggregate over a
+    join it does not multiply with other annotations, and it is computed
+    for the rows of the page only, unless the changelist is sorted on it.
+    '''
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(
+            value=aggregate).values('value'),
+        output_field=output_field,
+    ), Value(0), output_field=output_field)
+
+
 @admin.register(models.Image)
 class ImageAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'image']
@@ -31,20 +104,29 @@ class ProductVariantInline(admin.TabularInline):
 
 
 @admin.register(models.Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(ScalableChangeListMixin, admin.ModelAdmin):
     list_display = [
         'name', 'variants_count', 'category', 'images_count', 'available']
+    list_select_related = ['category']
     inlines = [ProductImageInline, ProductVariantInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            variant_count=related_aggregate(
+                models.ProductVariant.objects.all(), 'product', Count('pk'), IntegerField()),
+            image_count=related_aggregate(
+                models.ProductImage.objects.all(), 'product', Count('pk'), IntegerField()),
+        )
+
     def images_count(self, obj):
-        return obj.images.count()
+        return obj.image_count
     images_count.short_description = 'Images'
-    images_count.admin_order_field = 'images'
+    images_count.admin_order_field = 'image_count'
 
     def variants_count(self, obj):
-        return obj.variants.count()
+        return obj.variant_count
     variants_count.short_description = 'Variants'
-    variants_count.admin_order_field = 'variants'
+    variants_count.admin_order_field = 'variant_count'
 
 
 class CartItemInline(admin.TabularInline):
@@ -54,22 +136,32 @@ class CartItemInline(admin.TabularInline):
 
 
 @admin.register(models.Cart)
-class CartAdmin(admin.ModelAdmin):
+class CartAdmin(ScalableChangeListMixin, admin.ModelAdmin):
     list_display = ['user', 'cart_items_count', 'cart_price']
+    list_select_related = ['user']
     inlines = [CartItemInline]
 
+    def get_queryset(self, request):
+        lines = models.CartItem.objects.all()
+        return super().get_queryset(request).annotate(
+            line_count=related_aggregate(lines, 'cart', Count('pk'), IntegerField()),
+            price=related_aggregate(
+                lines, 'cart', Sum(F('quantity') * F('product_variant__price')), FloatField()),
+        )
+
     def cart_items_count(self, obj):
-        return obj.product_variants.count()
+        return obj.line_count
     cart_items_count.short_description = 'Cart Items'
-    cart_items_count.admin_order_field = 'product_variants'
+    cart_items_count.admin_order_field = 'line_count'
 
     def cart_price(self, obj):
-        total = 0
-        for item in models.CartItem.objects.filter(cart=obj):
-            total += item.product_variant.price * item.quantity
-        return total
+        return obj.price
     cart_price.short_description = 'Cart Price'
-    cart_price.admin_order_field = 'product_variants'
+    cart_price.admin_order_field = 'price'
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        carts.touch_cart(form.instance, full=True)
 
 
 class OrderItemInline(admin.TabularInline):
@@ -92,13 +184,41 @@ class OrderStatusInline(admin.TabularInline):
         return 1
 
 
+def change_status_action(status):
+    name = models.STATUS_CHOICES[status]
+
+    @admin.action(description=f'Mark selected orders as {name}')
+    def change_status(modeladmin, request, queryset):
+        changed, rejected = orders.change_status(
+            queryset.order_by().values_list('pk', flat=True), status)
+        modeladmin.message_user(request, f'{len(changed)} orders marked as {name}.')
+        terminal = {
+            f'Already {models.STATUS_CHOICES[terminal_status]}'
+            for terminal_status in orders.TERMINAL_STATUSES}
+        ended = sum(reason in terminal for reason in rejected.values())
+        if ended:
+            modeladmin.message_user(
+                request, f'{ended} orders are cancelled or returned and cannot change status.',
+                messages.WARNING)
+        if len(rejected) > ended:
+            modeladmin.message_user(
+                request, f'{len(rejected) - ended} orders were left unchanged, being already '
+                f'{name} or further along.', messages.WARNING)
+
+    change_status.__name__ = f'mark_{name.lower()}'
+    return change_status
+
+
 @admin.register(models.Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(ScalableChangeListMixin, admin.ModelAdmin):
     list_display = ['id', 'user', 'total', 'created_at', 'status']
+    list_select_related = ['user']
     readonly_fields = ['id', 'created_at', 'status']
     inlines = [OrderItemInline, OrderStatusInline]
     search_fields = ['id', 'user__username']
     list_filter = ['created_at', filters.OrderStatusFilter]
+    actions = [
+        change_status_action(status) for status in range(1, len(models.STATUS_CHOICES))]
 
     def get_readonly_fields(self, request, obj=None):
         fields = super().get_readonly_fields(request, obj)
@@ -107,6 +227,18 @@ class OrderAdmin(admin.ModelAdmin):
         return fields
 
 
+@admin.register(models.ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'total', 'created_at', 'status', 'archived_at']
+    search_fields = ['id', 'user__username']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(models.Coupon)
 class CouponAdmin(admin.ModelAdmin):
     list_display = [
@@ -0,0 +1,178 @@
+import hashlib
+from ecom import models
+from ecom import search
+from ecom.cache import get_catalog_snapshot
+from django.db import connection
+from django.db.models import Case, Count, Exists, IntegerField, OuterRef, Q, Value, When
+from django.db.models.expressions import RawSQL
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend, SearchFilter
+from rest_framework.settings import api_settings
+
+PRICE_BUCKETS = [
+    (0, 250),
+    (250, 500),
+    (500, 1000),
+    (1000, 2500),
+    (2500, 5000),
+    (5000, None),
+]
+
+
+class ProductSearchFilter(SearchFilter):
+    '''
+    Searches the products through the search index instead of running
+    icontains lookups, ordering the results by relevance unless the request
+    asks for another ordering. Until the index is created it runs the
+    icontains lookups on the search_fields of the view.
+    '''
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '')
+        if not query.strip():
+            return queryset
+        product_ids = search.search_products(query)
+        if product_ids is None:
+            # A subquery, only run when the view counts the facets.
+            view.search_product_ids = super().filter_queryset(
+                request, models.Product.objects.all(), view).values('pk')
+            return super().filter_queryset(request, queryset, view)
+        view.search_product_ids = product_ids
+        queryset = queryset.filter(pk__in=product_ids)
+        if product_ids and not request.query_params.get(api_settings.ORDERING_PARAM):
+            queryset = queryset.order_by(self.relevance(queryset, product_ids))
+        return queryset
+
+    def relevance(self, queryset, product_ids):
+        # A plain CASE is much cheaper to compile than hundreds of When()s.
+        column = '{}.{}'.format(
+            connection.ops.quote_name(queryset.model._meta.db_table),
+            connection.ops.quote_name(queryset.model._meta.pk.column))
+        params = []
+        for rank, product_id in enumerate(product_ids):
+            params += [product_id, rank]
+        return RawSQL(
+            f"CASE {column} {' '.join(['WHEN %s THEN %s'] * len(product_ids))} END",
+            params).asc()
+
+
+class ProductFacetFilter(BaseFilterBackend):
+    '''
+    Filters the products on
+
+    - category: comma separated category ids
+    - min_price / max_price: the lowest variant price
+    - in_stock: true for products with an available variant in stock
+    - variant: a variant name
+
+    and, with ?facets=true, lets the view add the number of matching products
+    per category, price bucket and stock status. Each facet counts the
+    products matching every other filter, in one grouped query, and the
+    counts are cached until the catalog changes.
+    '''
+    facet_params = ['category', 'min_price', 'max_price', 'in_stock', 'variant']
+
+    def filter_queryset(self, request, queryset, view):
+        filters = self.get_filters(request)
+        view.facet_filters = filters
+        if 'price' in filters:
+            queryset = queryset.with_lowest_price()
+        return apply_filters(queryset, filters)
+
+    def get_filters(self, request):
+        params = request.query_params
+        filters = {}
+        if params.get('category'):
+            filters['category'] = [Q(category_id__in=parse_ids(params['category'], 'category'))]
+        price = []
+        for param, lookup in [('min_price', 'gte'), ('max_price', 'lte')]:
+            if params.get(param):
+                try:
+                    price.append(Q(**{f'lowest_price__{lookup}': float(params[param])}))
+                except ValueError:
+                    raise ValidationError({param: 'A number is required.'})
+        if price:
+            filters['price'] = price
+        if params.get('in_stock'):
+            in_stock = in_stock_condition()
+            filters['in_stock'] = [
+                in_stock if params['in_stock'].lower() in ('true', '1') else ~in_stock]
+        if params.get('variant'):
+            filters['variant'] = [Exists(models.ProductVariant.objects.filter(
+                product=OuterRef('pk'), name__iexact=params['variant']))]
+        return filters
+
+
+def parse_ids(value, param):
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise ValidationError({param: 'A comma separated list of ids is required.'})
+
+
+def in_stock_condition():
+    return Q(available=True) & Q(Exists(models.ProductVariant.objects.filter(
+        product=OuterRef('pk'), available=True, stock__gt=0)))
+
+
+def apply_filters(queryset, filters, exclude=None):
+    for name, conditions in filters.items():
+        if name != exclude:
+            queryset = queryset.filter(*conditions)
+    return queryset
+
+
+def product_facets(request, filters, search_product_ids=None):
+    params = sorted(
+        (key, value) for key, value in request.query_params.items()
+        if key in ProductFacetFilter.facet_params or key == api_settings.SEARCH_PARAM)
+    name = 'facets:' + hashlib.sha1(repr(params).encode()).hexdigest()
+    return get_catalog_snapshot(
+        name, lambda: build_facets(filters, search_product_ids), stock=True)
+
+
+def build_facets(filters, search_product_ids=None):
+    base = models.Product.objects.order_by()
+    if search_product_ids is not None:
+        base = base.filter(pk__in=search_product_ids)
+    if 'price' in filters:
+        base = base.with_lowest_price()
+
+    categories = apply_filters(base, filters, exclude='category')
+    categories = categories.values(
+        'category_id', 'category__name'
+    ).annotate(count=Count('id')).order_by('category__name')
+
+    if 'price' not in filters:
+        base = base.with_lowest_price()
+    prices = apply_filters(base, filters, exclude='price')
+    prices = prices.annotate(bucket=Case(
+        *[When(
+            Q(lowest_price__gte=low) & (Q(lowest_price__lt=high) if high else Q()),
+            then=Value(index))
+          for index, (low, high) in enumerate(PRICE_BUCKETS)],
+        output_field=IntegerField()
+    )).values('bucket').annotate(count=Count('id'))
+    price_counts = {row['bucket']: row['count'] for row in prices}
+
+    stock = apply_filters(base, filters, exclude='in_stock')
+    stock = stock.annotate(in_stock=Case(
+        When(in_stock_condition(), then=Value(1)),
+        default=Value(0), output_field=IntegerField()
+    )).values('in_stock').annotate(count=Count('id'))
+    stock_counts = {row['in_stock']: row['count'] for row in stock}
+
+    return {
+        'categories': [
+            {'id': row['category_id'], 'name': row['category__name'], 'count': row['count']}
+            for row in categories
+        ],
+        'prices': [
+            {'min_price': low, 'max_price': high, 'count': price_counts.get(index, 0)}
+            for index, (low, high) in enumerate(PRICE_BUCKETS)
+        ],
+        'in_stock': {
+            'true': stock_counts.get(1, 0),
+            'false': stock_counts.get(0, 0),
+        },
+    }
@@ -0,0 +1,57 @@
+import hashlib
+from ecom.cache import catalog_version, stock_version, whishlist_version
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+
+class CatalogConditionalMixin:
+    '''
+    Answers list and retrieve requests with an ETag and Last-Modified taken
+    from the catalog version, and with a 304 before any queryset or
+    serializer runs when the client already has the current response.
+
+    Only the ETag is validated: Last-Modified has a resolution of a second,
+    in which the catalog can change more than once, so If-Modified-Since
+    alone never gets a 304.
+
+    Set whishlist_dependent on views whose responses include the whishlist
+    flags, so that the user's whishlist version is taken into account too,
+    and stock_params to the query parameters with which the responses depend
+    on the stock, so that the stock version is.
+    '''
+    whishlist_dependent = False
+    stock_params = ()
+
+    def get_versions(self, request):
+        versions = [catalog_version()]
+        if any(param in request.query_params for param in self.stock_params):
+            versions.append(stock_version())
+        if self.whishlist_dependent and request.user and request.user.is_authenticated:
+            versions.append(whishlist_version(request.user.pk))
+        return versions
+
+    def conditional(self, request, handler, *args, **kwargs):
+        versions = self.get_versions(request)
+        user_id = request.user.pk if self.whishlist_dependent and request.user else None
+        renderer = getattr(request, 'accepted_renderer', None)
+        key = repr([
+            versions, user_id, request.build_absolute_uri(),
+            renderer.format if renderer else None])
+        etag = '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+        last_modified = max(versions) // 1000
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code == 200:
+                response.headers['ETag'] = etag
+                response.headers['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, no_cache=True)
+        patch_vary_headers(response, ['Authorization', 'Cookie'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(request, super().retrieve, *args, **kwargs)
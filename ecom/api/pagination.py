@@ -0,0 +1,197 @@
+import json
+import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(PageNumberPagination):
+    '''
+    Page number pagination, with two opt-in modes chosen per request:
+
+    - ?pagination=cursor (or any ?cursor=) seeks past the last row of the
+      previous page on the view's keyset_ordering columns instead of using
+      OFFSET, and never counts the rows.
+    - ?count=false keeps page numbers but skips the COUNT(*) query, so the
+      response has no count.
+
+    In cursor mode the keyset ordering replaces any ?ordering= of the request.
+    '''
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.mode = 'page'
+        self.display_page_controls = False
+        if self.use_cursor(request):
+            self.mode = 'cursor'
+            return self.paginate_keyset(queryset, request, view)
+        if request.query_params.get(self.count_query_param, '').lower() in ('false', '0'):
+            self.mode = 'uncounted'
+            return self.paginate_uncounted(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.mode == 'page':
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if self.mode == 'page':
+            return super().get_next_link()
+        return self.next_link
+
+    def get_previous_link(self):
+        if self.mode == 'page':
+            return super().get_previous_link()
+        return self.previous_link
+
+    def use_cursor(self, request):
+        return (
+            request.query_params.get(self.mode_query_param) == 'cursor'
+            or self.cursor_query_param in request.query_params
+        )
+
+    def paginate_uncounted(self, queryset, request):
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        try:
+            page_number = int(request.query_params.get(self.page_query_param, 1))
+            if page_number < 1:
+                raise ValueError
+        except ValueError:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=request.query_params.get(self.page_query_param),
+                message='That page number is not a valid integer'))
+        offset = (page_number - 1) * page_size
+        results = list(queryset[offset:offset + page_size + 1])
+        if not results and page_number > 1:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number, message='That page contains no results'))
+
+        url = self.request.build_absolute_uri()
+        self.next_link = None
+        if len(results) > page_size:
+            self.next_link = replace_query_param(
+                url, self.page_query_param, page_number + 1)
+        self.previous_link = None
+        if page_number == 2:
+            self.previous_link = remove_query_param(url, self.page_query_param)
+        elif page_number > 2:
+            self.previous_link = replace_query_param(
+                url, self.page_query_param, page_number - 1)
+        return results[:page_size]
+
+    def paginate_keyset(self, queryset, request, view):
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        ordering = list(view.keyset_ordering)
+        position, reverse = self.decode_cursor(request)
+
+        if reverse:
+            queryset = queryset.order_by(*[flip(field) for field in ordering])
+        else:
+            queryset = queryset.order_by(*ordering)
+        if position is not None:
+            position = keyset_position(queryset.model, ordering, position)
+            queryset = queryset.filter(keyset_filter(ordering, position, reverse))
+
+        results = list(queryset[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+
+        self.next_link = None
+        self.previous_link = None
+        if results:
+            first = [keyset_value(results[0], field) for field in ordering]
+            last = [keyset_value(results[-1], field) for field in ordering]
+            # Going backwards there is always a next page (the one we came
+            # from), and going forwards there is a previous one unless this
+            # is the first page.
+            if reverse or has_more:
+                self.next_link = self.encode_cursor(last, False)
+            if (has_more if reverse else position is not None):
+                self.previous_link = self.encode_cursor(first, True)
+        return results
+
+    def encode_cursor(self, position, reverse):
+        token = urlsafe_b64encode(json.dumps(
+            {'p': position, 'r': int(reverse)}, separators=(',', ':')
+        ).encode()).decode()
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(token.encode()))
+            return list(cursor['p']), bool(cursor['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+def flip(field):
+    return field[1:] if field.startswith('-') else f'-{field}'
+
+
+def keyset_value(obj, field):
+    value = getattr(obj, field.lstrip('-'))
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def keyset_position(model, ordering, position):
+    '''
+    The values of a cursor position converted by the ordering fields of
+    model, so that a tampered cursor is rejected like an undecodable one.
+    '''
+    if len(position) != len(ordering):
+        raise NotFound(KeysetPagination.invalid_cursor_message)
+    try:
+        values = []
+        for field, value in zip(ordering, position):
+            if value is None:
+                raise ValueError
+            name = field.lstrip('-')
+            model_field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            values.append(model_field.to_python(value))
+        return values
+    except (ValidationError, TypeError, ValueError):
+        raise NotFound(KeysetPagination.invalid_cursor_message)
+
+
+def keyset_filter(ordering, position, reverse=False):
+    '''
+    Rows after position in the given ordering (before it when reverse), as
+    (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+    '''
+    if len(position) != len(ordering):
+        raise NotFound(KeysetPagination.invalid_cursor_message)
+    condition = Q()
+    for index, field in enumerate(ordering):
+        name = field.lstrip('-')
+        descending = field.startswith('-') != reverse
+        step = Q(**{f"{name}__{'lt' if descending else 'gt'}": position[index]})
+        for previous, value in zip(ordering[:index], position):
+            step &= Q(**{previous.lstrip('-'): value})
+        condition |= step
+    return condition
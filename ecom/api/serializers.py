@@ -1,19 +1,106 @@
+from ecom import carts
+from ecom import inventory
 from ecom import utils
 from ecom import models
+from ecom.images import image_sources
+from django.db import transaction
 from django.db.models import Min, Max
 from rest_framework import serializers
 from rest_framework.serializers import ValidationError
 import re
 
 
-class CategorySerializer(serializers.ModelSerializer):
+def parse_field_list(value):
+    '''
+    Turns "id,name,images.image_url" into
+    {'id': {}, 'name': {}, 'images': {'image_url': {}}}.
+    '''
+    tree = {}
+    for path in (value or '').split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def sparse_fields(request):
+    '''
+    The ?fields= and ?omit= of a request as trees of field names. fields is
+    None when every field is requested.
+    '''
+    params = getattr(request, 'query_params', None) or {}
+    return parse_field_list(params.get('fields')) or None, parse_field_list(params.get('omit'))
+
+
+def requested_fields(request, serializer_class, path=''):
+    '''
+    The names of the fields of serializer_class that will be rendered for
+    the request, where path is the dotted path of the serializer within
+    the response ('' for the top level).
+    '''
+    include, omit = sparse_fields(request)
+    for name in filter(None, path.split('.')):
+        if include is not None:
+            if name not in include:
+                return []
+            include = include[name] or None
+        if name in omit and not omit[name]:
+            return []
+        omit = omit.get(name, {})
+    return [
+        name for name in serializer_class.Meta.fields
+        if (include is None or name in include) and not (name in omit and not omit[name])
+    ]
+
+
+class SparseFieldsMixin:
+    '''
+    Renders only the fields asked for with ?fields=id,name or not excluded
+    with ?omit=description. Nested fields are given with dotted names, e.g.
+    ?fields=id,images.image_url.
+
+    The fields are dropped from the serializer before anything is rendered,
+    so the methods and nested serializers of the other fields never run.
+    Serializers given data to validate always keep all their fields.
+    '''
+
+    def get_fields(self):
+        fields = super().get_fields()
+        include, omit = self.get_sparse_fields()
+        if include is not None:
+            fields = {name: field for name, field in fields.items() if name in include}
+        fields = {
+            name: field for name, field in fields.items()
+            if not (name in omit and not omit[name])
+        }
+        for name, field in fields.items():
+            child = getattr(field, 'child', field)
+            if isinstance(child, SparseFieldsMixin):
+                child.sparse_fields = (
+                    (include or {}).get(name) or None, omit.get(name, {}))
+        return fields
+
+    def get_sparse_fields(self):
+        if hasattr(self, 'sparse_fields'):
+            return self.sparse_fields
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        if parent is not None or hasattr(self, 'initial_data'):
+            return None, {}
+        return sparse_fields(self.context.get('request'))
+
+
+class CategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField(read_only=True)
+    image_sources = serializers.SerializerMethodField(read_only=True)
     total_products = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = models.Category
-        fields = ['id', 'name', 'image', 'image_url', 'total_products']
-        read_only_fields = ['id', 'image_url', 'total_products']
+        fields = ['id', 'name', 'image', 'image_url', 'image_sources', 'total_products']
+        read_only_fields = ['id', 'image_url', 'image_sources', 'total_products']
 
     def get_image_url(self, obj):
         request = self.context.get('request')
@@ -21,11 +108,16 @@ class CategorySerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(obj.image.image.url)
         return None
 
+    def get_image_sources(self, obj):
+        return image_sources(obj.image, self.context.get('request'))
+
     def get_total_products(self, obj):
+        if hasattr(obj, 'product_count'):
+            return obj.product_count
         return obj.products.count()
 
 
-class ProductVariantSerializer(serializers.ModelSerializer):
+class ProductVariantSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.ProductVariant
         fields = [
@@ -33,14 +125,15 @@ class ProductVariantSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
 
 
-class ProductImageSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     name = serializers.SerializerMethodField(read_only=True)
     image_url = serializers.SerializerMethodField(read_only=True)
+    image_sources = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = models.ProductImage
-        fields = ['id', 'name', 'image_url']
-        read_only_fields = ['id', 'image_url']
+        fields = ['id', 'name', 'image_url', 'image_sources']
+        read_only_fields = ['id', 'image_url', 'image_sources']
 
     def get_name(self, obj):
         return obj.image.name
@@ -51,8 +144,11 @@ class ProductImageSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(obj.image.image.url)
         return None
 
+    def get_image_sources(self, obj):
+        return image_sources(obj.image, self.context.get('request'))
 
-class ProductSerializer(serializers.ModelSerializer):
+
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     images = ProductImageSerializer(
         many=True, read_only=True, source='productimage_set')
     variants = ProductVariantSerializer(
@@ -68,14 +164,20 @@ class ProductSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'variants', 'images', 'whishlist']
 
     def get_start_price(self, obj):
+        if hasattr(obj, 'min_price'):
+            return obj.min_price
         return obj.variants.aggregate(Min('price'))['price__min']
 
     def get_end_price(self, obj):
+        if hasattr(obj, 'max_price'):
+            return obj.max_price if obj.variant_count > 1 else None
         if obj.variants.count() > 1:
             return obj.variants.aggregate(Max('price'))['price__max']
         return None
 
     def get_whishlist(self, obj):
+        if hasattr(obj, 'is_whishlisted'):
+            return obj.is_whishlisted
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return models.Wishlist.objects.filter(
@@ -83,7 +185,7 @@ class ProductSerializer(serializers.ModelSerializer):
         return False
 
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product = ProductSerializer()
 
     class Meta:
@@ -91,13 +193,13 @@ class WishlistSerializer(serializers.ModelSerializer):
         fields = ['product', 'added_at']
 
 
-class WishlistCreateSerializer(serializers.ModelSerializer):
+class WishlistCreateSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Wishlist
         fields = ['product']
 
 
-class CategoryProductSerializer(serializers.ModelSerializer):
+class CategoryProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     products = ProductSerializer(many=True, read_only=True)
     total_products = serializers.SerializerMethodField(read_only=True)
 
@@ -106,10 +208,12 @@ class CategoryProductSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'products', 'total_products']
 
     def get_total_products(self, obj):
+        if hasattr(obj, 'product_count'):
+            return obj.product_count
         return obj.products.count()
 
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Address
         fields = [
@@ -133,7 +237,20 @@ class AddressSerializer(serializers.ModelSerializer):
         return value
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartLineListSerializer(serializers.ListSerializer):
+    '''
+    Renders only the lines changed after the version in context['since'],
+    when there is one.
+    '''
+
+    def to_representation(self, data):
+        since = self.context.get('since')
+        if since is not None:
+            data = [line for line in data if line.version > since]
+        return super().to_representation(data)
+
+
+class CartItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product = serializers.SerializerMethodField(read_only=True)
     image = serializers.SerializerMethodField(read_only=True)
 
@@ -143,6 +260,7 @@ class CartItemSerializer(serializers.ModelSerializer):
             'product_variant', 'product', 'quantity', 'image']
         read_only_fields = ['id', 'product']
         lookup_field = 'product_variant'
+        list_serializer_class = CartLineListSerializer
 
     def get_product(self, obj: models.CartItem):
         return {
@@ -156,36 +274,99 @@ class CartItemSerializer(serializers.ModelSerializer):
 
     def get_image(self, obj: models.CartItem):
         request = self.context.get('request')
-        images = obj.product_variant.product.images.all()
-        if images.exists():
-            image = images[0]
+        product = obj.product_variant.product
+        if hasattr(product, 'cover_images'):
+            images = product.cover_images
+        else:
+            images = product.productimage_set.select_related(
+                'image').order_by('sort_order', 'id')[:1]
+        if images:
+            image = images[0].image
             name = image.name
             image_url = request.build_absolute_uri(image.image.url)
             return {
                 'name': name,
-                'image_url': image_url
+                'image_url': image_url,
+                'image_sources': image_sources(image, request),
             }
         return None
 
-    def validate_product_variant(self, value):
-        cart_items = models.CartItem.objects.filter(
-            cart_id=self.context['cart'], product_variant=value)
-        if self.context.get('create') and cart_items.exists():
-            cart_items.delete()
-        return value
-
     def create(self, validated_data):
-        validated_data['cart'] = self.context['cart']
-        return super().create(validated_data)
+        # Replaces the line of the variant if the cart has one already,
+        # also when a concurrent request has just created it.
+        line, _ = models.CartItem.objects.update_or_create(
+            cart=self.context['cart'], product_variant=validated_data['product_variant'],
+            defaults={'quantity': validated_data.get('quantity', 1)})
+        return line
 
     def update(self, instance, validated_data):
-        validated_data['cart'] = self.context['cart']
+        cart = self.context['cart']
+        variant = validated_data.get('product_variant', instance.product_variant)
+        if variant.pk != instance.product_variant_id:
+            # Moving the line to a variant the cart has already adds it to
+            # the line of that variant.
+            with transaction.atomic():
+                line = models.CartItem.objects.select_for_update().filter(
+                    cart=cart, product_variant=variant).first()
+                if line is not None:
+                    line.quantity += validated_data.get('quantity', instance.quantity)
+                    line.save(update_fields=['quantity'])
+                    instance.delete()
+                    return line
+        validated_data['cart'] = cart
         return super().update(instance, validated_data)
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product_variant = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, required=False, default=1)
+
+
+class CartBatchSerializer(serializers.Serializer):
+    '''
+    A list of operations applied to the cart in order:
+
+    - add: adds quantity to the line of the variant, creating it if needed
+    - set: sets the quantity of the line of the variant
+    - remove: removes the line of the variant
+    '''
+    operations = CartOperationSerializer(many=True, allow_empty=False)
+
+    def validate_operations(self, operations):
+        variant_ids = {operation['product_variant'] for operation in operations}
+        existing = set(models.ProductVariant.objects.filter(
+            pk__in=variant_ids).values_list('pk', flat=True))
+        missing = sorted(variant_ids - existing)
+        if missing:
+            raise ValidationError(
+                f"Invalid product variants: {', '.join(map(str, missing))}")
+        return operations
+
+    def create(self, validated_data):
+        cart = self.context['cart']
+        operations = validated_data['operations']
+        if isinstance(cart, carts.GuestCart):
+            cart.apply(operations)
+            cart.save()
+            return cart
+        variant_ids = {operation['product_variant'] for operation in operations}
+        with transaction.atomic():
+            lines = {
+                line.product_variant_id: line
+                for line in models.CartItem.objects.select_for_update().filter(
+                    cart=cart, product_variant_id__in=variant_ids)
+            }
+            quantities = carts.apply_operations({
+                variant_id: line.quantity for variant_id, line in lines.items()
+            }, operations)
+            carts.sync_lines(cart, quantities, lines)
+        return cart
+
+
+class CartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     products = CartItemSerializer(
-        many=True, read_only=True, source='cartitem_set')
+        many=True, read_only=True, source='pricing.items')
     coupon = serializers.SerializerMethodField(read_only=True)
     sub_total = serializers.SerializerMethodField(read_only=True)
     discount = serializers.SerializerMethodField(read_only=True)
@@ -193,13 +374,27 @@ class CartSerializer(serializers.ModelSerializer):
     tax = serializers.SerializerMethodField(read_only=True)
     total = serializers.SerializerMethodField(read_only=True)
     address = AddressSerializer(read_only=True)
+    version = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = models.Cart
         fields = [
-            'user', 'address', 'products', 'coupon', 'payment_mode', 'sub_total', 'discount', 'shipping', 'tax', 'total']
+            'user', 'address', 'products', 'coupon', 'payment_mode', 'sub_total', 'discount', 'shipping', 'tax', 'total', 'version']
         read_only_fields = [
-            'user', 'address', 'products', 'coupon', 'payment_mode', 'sub_total', 'discount', 'shipping', 'tax', 'total']
+            'user', 'address', 'products', 'coupon', 'payment_mode', 'sub_total', 'discount', 'shipping', 'tax', 'total', 'version']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        since = self.context.get('since')
+        if since is not None:
+            data['removed'] = [
+                int(variant_id) for variant_id, version in instance.removed_lines.items()
+                if version > since
+            ]
+        return data
+
+    def get_version(self, obj):
+        return carts.version_token(obj)
 
     def get_coupon(self, obj):
         if obj.coupon:
@@ -207,22 +402,22 @@ class CartSerializer(serializers.ModelSerializer):
         return None
 
     def get_sub_total(self, obj):
-        return obj.sub_total
+        return obj.pricing.sub_total
 
     def get_discount(self, obj):
-        return utils.calculate_discount(obj)
+        return obj.pricing.discount
 
     def get_shipping(self, obj):
-        return utils.calculate_shipping(obj)
+        return obj.pricing.shipping
 
     def get_tax(self, obj):
-        return utils.calculate_tax(obj)
+        return obj.pricing.tax
 
     def get_total(self, obj):
-        return utils.calculate_total(obj)
+        return obj.pricing.total
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.OrderItem
         fields = [
@@ -231,7 +426,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
             'product_name', 'variant_name', 'product_variant', 'quantity', 'price', 'total']
 
 
-class OrderStatusSerializer(serializers.ModelSerializer):
+class OrderStatusSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     name = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
@@ -243,7 +438,7 @@ class OrderStatusSerializer(serializers.ModelSerializer):
         return models.STATUS_CHOICES[obj.status]
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     statuses = OrderStatusSerializer(many=True, read_only=True)
 
@@ -251,21 +446,98 @@ class OrderSerializer(serializers.ModelSerializer):
         model = models.Order
         fields = [
             'id', 'name', 'address', 'city', 'state', 'pincode', 'landmark',
-            'phone_number', 'alternate_phone_number', 'total', 'created_at', 'status', 'items', 'statuses']
+            'phone_number', 'alternate_phone_number', 'sub_total', 'discount', 'coupon_code',
+            'shipping', 'tax', 'total', 'created_at', 'status', 'items', 'statuses']
         read_only_fields = [
             'id', 'name', 'address', 'city', 'state', 'pincode', 'landmark',
-            'phone_number', 'alternate_phone_number', 'total', 'created_at', 'status', 'items', 'statuses']
+            'phone_number', 'alternate_phone_number', 'sub_total', 'discount', 'coupon_code',
+            'shipping', 'tax', 'total', 'created_at', 'status', 'items', 'statuses']
 
     def validate(self, attrs):
-        if not models.CartItem.objects.filter(cart__user=self.context['user']).count():
+        cart = self.context['cart']
+        if not utils.get_pricing(cart).items:
             raise ValidationError('Your cart is empty')
-        if not models.Cart.objects.filter(user=self.context['user']).first().address:
+        if not cart.address:
             raise ValidationError('Address is required for placing order')
         return super().validate(attrs)
 
+    def to_representation(self, instance):
+        if isinstance(instance, models.ArchivedOrder):
+            return {name: instance.data.get(name) for name in self.fields}
+        return super().to_representation(instance)
+
     def create(self, validated_data):
-        validated_data['user'] = self.context['user']
-        return super().create(validated_data)
+        '''
+        Places the order for the cart as one transaction: the order with the
+        address and a snapshot of the pricing, the stock, the items, the
+        first status and the emptied cart, in the same number of queries
+        whatever the size of the cart.
+        '''
+        cart = self.context['cart']
+        pricing = utils.get_pricing(cart)
+        address = cart.address
+        with transaction.atomic():
+            order = models.Order.objects.create(
+                user=self.context['user'],
+                name=address.name,
+                address=address.address,
+                city=address.city,
+                state=address.state,
+                pincode=address.pincode,
+                landmark=address.landmark,
+                phone_number=address.phone_number,
+                alternate_phone_number=address.alternate_phone_number,
+                sub_total=pricing.sub_total,
+                discount=pricing.discount,
+                coupon_code=pricing.coupon.code if pricing.discount else None,
+                shipping=pricing.shipping,
+                tax=pricing.tax,
+                total=pricing.total,
+                status=models.STATUS_CHOICES[0],
+                **validated_data,
+            )
+            # Raises OutOfStock, a validation error, rolling the order back.
+            inventory.reserve(order, {
+                item.product_variant_id: item.quantity for item in pricing.items})
+            models.OrderItem.objects.bulk_create([
+                models.OrderItem(
+                    order=order,
+                    product_variant=item.product_variant,
+                    product_name=item.product_variant.product.name,
+                    variant_name=item.product_variant.name,
+                    quantity=item.quantity,
+                    price=item.product_variant.price,
+                    total=item.product_variant.price * item.quantity,
+                )
+                for item in pricing.items
+            ])
+            # Created in bulk, as the status of the order is set above.
+            models.OrderStatus.objects.bulk_create([
+                models.OrderStatus(order=order, status=0)])
+            models.CartItem.objects.filter(cart=cart).delete()
+            carts.touch_cart(
+                cart, removed=[item.product_variant_id for item in pricing.items])
+        return order
+
+
+class OrderSummarySerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    '''
+    An order in the order list with ?view=summary, without its items and
+    statuses; item_count is its number of lines.
+    '''
+    item_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = models.Order
+        fields = ['id', 'created_at', 'total', 'status', 'item_count']
+        read_only_fields = ['id', 'created_at', 'total', 'status', 'item_count']
+
+
+class OrderStatusChangeSerializer(serializers.Serializer):
+    orders = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=10000)
+    status = serializers.ChoiceField(
+        choices=[(index, choice) for index, choice in enumerate(models.STATUS_CHOICES)])
 
 
 class CouponSerializer(serializers.Serializer):
@@ -276,10 +548,10 @@ class CouponSerializer(serializers.Serializer):
         cart = self.context.get('cart')
         if not cart:
             raise ValidationError('Cart is required for coupon validation')
-        coupon = models.Coupon.objects.filter(code=code)
-        if not coupon.exists():
+        self.coupon = models.Coupon.objects.filter(code=code).first()
+        if not self.coupon:
             raise ValidationError('Invalid coupon code')
-        return utils.validate_coupon(cart, coupon[0])
+        return utils.get_pricing(cart).validate_coupon(self.coupon)
 
 
 class PaymentSerializer(serializers.Serializer):
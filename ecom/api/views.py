@@ -1,15 +1,28 @@
+import hashlib
+from ecom import archive
+from ecom import carts
+from ecom import orders
 from ecom import utils
 from ecom import models
+from ecom.cache import get_catalog_snapshot
+from . import filters
+from . import mixins
+from . import pagination
 from . import serializers
 
+from django.db.models import Count, Prefetch, prefetch_related_objects
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 
 from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.permissions import AllowAny
+from rest_framework.permissions import IsAdminUser
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.viewsets import ReadOnlyModelViewSet, ViewSet, generics, ModelViewSet
 
@@ -19,32 +32,119 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 # Create your views here.
 
 
-class CategoryViewSet(ReadOnlyModelViewSet):
-    queryset = models.Category.objects.all()
+class CategoryViewSet(mixins.CatalogConditionalMixin, ReadOnlyModelViewSet):
+    queryset = models.Category.objects.select_related('image').annotate(
+        product_count=Count('products')).order_by('name')
     serializer_class = serializers.CategorySerializer
     permission_classes = (AllowAny, )
     pagination_class = None
 
 
-class ProductViewSet(ReadOnlyModelViewSet):
+class ProductViewSet(mixins.CatalogConditionalMixin, ReadOnlyModelViewSet):
     queryset = models.Product.objects.all()
+    whishlist_dependent = True
+    stock_params = ('in_stock', 'facets')
     serializer_class = serializers.ProductSerializer
     permission_classes = (AllowAny, )
     authentication_classes = (JWTAuthentication, SessionAuthentication)
-    pagination_class = PageNumberPagination
-    filter_backends = (SearchFilter, OrderingFilter)
+    pagination_class = pagination.KeysetPagination
+    keyset_ordering = ('-available', 'name', 'id')
+    bulk_max_ids = 100
+    filter_backends = (
+        filters.ProductSearchFilter, filters.ProductFacetFilter, OrderingFilter)
     search_fields = ['name', 'description']
     ordering_fields = '__all__'
     format_kwarg = None  # to access from other views
 
+    def get_queryset(self):
+        return models.Product.objects.for_catalog(
+            self.request.user,
+            fields=serializers.requested_fields(self.request, self.serializer_class))
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200 and request.query_params.get('facets') == 'true':
+            response.data['facets'] = filters.product_facets(
+                request, self.facet_filters, getattr(self, 'search_product_ids', None))
+        return response
+
+    @action(detail=False, methods=['get'])
+    def bulk(self, request):
+        '''
+        The products with the ?ids= given as a comma separated list, in that
+        order, with the ids that do not exist listed under missing.
+        '''
+        return self.conditional(request, self.bulk_products)
+
+    def bulk_products(self, request):
+        ids = list(dict.fromkeys(
+            filters.parse_ids(request.query_params.get('ids', ''), 'ids')))
+        if not ids:
+            raise ValidationError({'ids': 'At least one id is required.'})
+        if len(ids) > self.bulk_max_ids:
+            raise ValidationError(
+                {'ids': f'At most {self.bulk_max_ids} ids can be fetched at once.'})
+        products = self.get_queryset().filter(pk__in=ids).order_by().in_bulk()
+        serializer = self.get_serializer(
+            [products[pk] for pk in ids if pk in products], many=True)
+        return Response({
+            'results': serializer.data,
+            'missing': [pk for pk in ids if pk not in products],
+        })
+
 
-class CategoryProductViewSet(ReadOnlyModelViewSet):
+class CategoryProductViewSet(mixins.CatalogConditionalMixin, ReadOnlyModelViewSet):
     queryset = models.Category.objects.all()
+    whishlist_dependent = True
     serializer_class = serializers.CategoryProductSerializer
     permission_classes = (AllowAny, )
     pagination_class = None
     format_kwarg = None  # to access from other views
 
+    def get_queryset(self, user=None):
+        queryset = models.Category.objects.order_by('name')
+        fields = serializers.requested_fields(self.request, self.serializer_class)
+        if 'total_products' in fields:
+            queryset = queryset.annotate(product_count=Count('products'))
+        if 'products' in fields:
+            products = models.Product.objects.for_catalog(
+                user or self.request.user,
+                fields=serializers.requested_fields(
+                    self.request, serializers.ProductSerializer, 'products'))
+            queryset = queryset.prefetch_related(Prefetch('products', queryset=products))
+        return queryset
+
+    def list(self, request):
+        return self.conditional(request, self.list_snapshot)
+
+    def list_snapshot(self, request):
+        '''
+        The tree is the same for every user apart from the whishlist flags,
+        so it is cached without them and they are filled in per request.
+        '''
+        fields = serializers.requested_fields(
+            request, serializers.ProductSerializer, 'products')
+        authenticated = request.user and request.user.is_authenticated
+        if authenticated and 'whishlist' in fields and 'id' not in fields:
+            # Without the ids the flags cannot be filled in afterwards.
+            return Response(self.get_serializer(self.get_queryset(), many=True).data)
+        sparse = hashlib.sha1(repr(serializers.sparse_fields(request)).encode()).hexdigest()
+        data = get_catalog_snapshot(
+            f"category-products:{request.build_absolute_uri('/')}:{sparse}",
+            lambda: self.build_snapshot(request))
+        if authenticated and 'whishlist' in fields:
+            whishlist = set(models.Wishlist.objects.filter(
+                user=request.user).values_list('product_id', flat=True))
+            for category in data:
+                for product in category.get('products', []):
+                    product['whishlist'] = product['id'] in whishlist
+        return Response(data)
+
+    def build_snapshot(self, request):
+        queryset = self.get_queryset(user=AnonymousUser())
+        serializer = self.get_serializer(queryset, many=True)
+        return serializer.data
+
 
 class WhishlistViewSet(ViewSet, generics.ListAPIView):
     permission_classes = (IsAuthenticated, )
@@ -56,11 +156,16 @@ class WhishlistViewSet(ViewSet, generics.ListAPIView):
         return serializers.WishlistCreateSerializer
 
     def get_queryset(self):
-        return models.Wishlist.objects.filter(user=self.request.user)
+        products = models.Product.objects.for_catalog(
+            self.request.user,
+            fields=serializers.requested_fields(
+                self.request, serializers.ProductSerializer, 'product'))
+        return models.Wishlist.objects.filter(
+            user=self.request.user
+        ).prefetch_related(Prefetch('product', queryset=products))
 
     def retrieve(self, request, pk):
-        wishlist = get_object_or_404(
-            models.Wishlist, product_id=pk, user=request.user)
+        wishlist = get_object_or_404(self.get_queryset(), product_id=pk)
         serializer = serializers.WishlistSerializer(
             wishlist, context={'request': request})
         return Response(serializer.data)
@@ -91,110 +196,231 @@ class WhishlistViewSet(ViewSet, generics.ListAPIView):
 
 
 class CartViewSet(ViewSet):
-    permission_classes = (IsAuthenticated, )
+    '''
+    The cart of the user, or for visitors who have not logged in their guest
+    cart, which is kept in the cache (see ecom.carts).
+    '''
+    permission_classes = (AllowAny, )
     authentication_classes = (JWTAuthentication, SessionAuthentication)
     serializer_class = serializers.CartItemSerializer
 
     def list(self, request):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
-        serializer = serializers.CartSerializer(
-            cart, context={'request': request})
+        '''
+        The cart. With ?since= set to the version of a previous response,
+        304 when nothing changed since, or else the cart with only the
+        lines that changed and the variant ids of the lines removed since.
+        '''
+        if not request.user.is_authenticated:
+            return self.guest_list(request, carts.GuestCart.from_request(request))
+        since = request.query_params.get('since')
+        if since is not None:
+            cart = carts.get_cart(request)
+            if since == carts.version_token(cart):
+                return Response(status=status.HTTP_304_NOT_MODIFIED)
+            since = carts.parse_version_token(cart, since)
+        cart = carts.get_cart(request, lines=True, images=since is None)
+        context = {'request': request}
+        if since is not None:
+            context['since'] = since
+            prefetch_related_objects(
+                [line.product_variant.product for line in cart.pricing.items
+                 if line.version > since],
+                Prefetch(
+                    'productimage_set',
+                    queryset=models.ProductImage.objects.select_related(
+                        'image').order_by('sort_order', 'id')[:1],
+                    to_attr='cover_images'))
+        serializer = serializers.CartSerializer(cart, context=context)
         return Response(serializer.data)
 
     def retrieve(self, request, pk):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        if not request.user.is_authenticated:
+            return self.guest_retrieve(request, pk)
+        cart = carts.get_cart(request)
         cart_item = get_object_or_404(
-            models.CartItem, cart=cart, product_variant_id=pk)
+            models.CartItem.objects.select_related('product_variant__product'),
+            cart=cart, product_variant_id=pk)
         serializer = serializers.CartItemSerializer(
             cart_item, context={'request': request})
         return Response(serializer.data)
 
     def create(self, request):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        if not request.user.is_authenticated:
+            return self.guest_update(request, None, status.HTTP_201_CREATED)
+        cart = carts.get_cart(request)
         serializer = serializers.CartItemSerializer(
             data=request.data, context={'create': True, 'cart': cart})
         if serializer.is_valid():
             serializer.save()
+            carts.touch_cart(cart, changed=[serializer.instance.product_variant_id])
             response = self.list(request)
             response.status_code = status.HTTP_201_CREATED
             return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def update(self, request, pk):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        if not request.user.is_authenticated:
+            return self.guest_update(request, pk)
+        cart = carts.get_cart(request)
         cart_item = get_object_or_404(
             models.CartItem, cart=cart, product_variant_id=pk)
         serializer = serializers.CartItemSerializer(
             cart_item, data=request.data, context={'cart': cart})
         if serializer.is_valid():
             serializer.save()
+            carts.touch_cart(
+                cart, changed=[serializer.instance.product_variant_id], removed=[int(pk)])
             response = self.list(request)
             return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def partial_update(self, request, pk):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        if not request.user.is_authenticated:
+            return self.guest_update(request, pk, partial=True)
+        cart = carts.get_cart(request)
         cart_item = get_object_or_404(
             models.CartItem, cart=cart, product_variant_id=pk)
         serializer = serializers.CartItemSerializer(
             cart_item, data=request.data, partial=True, context={'cart': cart})
         if serializer.is_valid():
             serializer.save()
+            carts.touch_cart(
+                cart, changed=[serializer.instance.product_variant_id], removed=[int(pk)])
             response = self.list(request)
             return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def destroy(self, request, pk):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        if not request.user.is_authenticated:
+            guest = carts.GuestCart.from_request(request)
+            guest.apply([{'op': 'remove', 'product_variant': self.guest_line(guest, pk)}])
+            guest.save()
+            return guest.set_token(Response(status=status.HTTP_204_NO_CONTENT))
+        cart = carts.get_cart(request)
         cart_item = get_object_or_404(
             models.CartItem, cart=cart, product_variant_id=pk)
         cart_item.delete()
+        carts.touch_cart(cart, removed=[cart_item.product_variant_id])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        'Apply several add, set and remove operations and return the cart once'
+        if request.user.is_authenticated:
+            cart = carts.get_cart(request)
+        else:
+            cart = carts.GuestCart.from_request(request)
+        serializer = serializers.CartBatchSerializer(
+            data=request.data, context={'cart': cart})
+        if serializer.is_valid():
+            serializer.save()
+            if isinstance(cart, carts.GuestCart):
+                return self.guest_list(request, cart)
+            return self.list(request)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def guest_line(self, guest, pk):
+        'The variant id of the line pk of the guest cart'
+        try:
+            variant_id = int(pk)
+        except (TypeError, ValueError):
+            raise Http404
+        if variant_id not in guest.items:
+            raise Http404
+        return variant_id
+
+    def guest_list(self, request, guest, status_code=status.HTTP_200_OK):
+        serializer = serializers.CartSerializer(
+            guest.as_cart(), context={'request': request})
+        response = Response(serializer.data, status=status_code)
+        if guest.items:
+            guest.set_token(response)
+        return response
+
+    def guest_retrieve(self, request, pk):
+        guest = carts.GuestCart.from_request(request)
+        variant_id = self.guest_line(guest, pk)
+        for cart_item in guest.as_cart().pricing.items:
+            if cart_item.product_variant_id == variant_id:
+                serializer = serializers.CartItemSerializer(
+                    cart_item, context={'request': request})
+                return Response(serializer.data)
+        raise Http404
+
+    def guest_update(self, request, pk, status_code=status.HTTP_200_OK, partial=False):
+        '''
+        Sets the line of a variant like create, update and partial_update do
+        for the carts of users, where pk is None for create.
+        '''
+        guest = carts.GuestCart.from_request(request)
+        operations = []
+        if pk is not None:
+            variant_id = self.guest_line(guest, pk)
+            operations.append({'op': 'remove', 'product_variant': variant_id})
+        serializer = serializers.CartItemSerializer(
+            data=request.data, partial=partial, context={'cart': None})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        variant = serializer.validated_data.get('product_variant')
+        quantity = serializer.validated_data.get('quantity')
+        if pk is not None and quantity is None:
+            quantity = guest.items[variant_id]
+        # Like for users, a line moved to a variant the cart has already is
+        # added to the line of that variant.
+        operations.append({
+            'op': 'set' if pk is None else 'add',
+            'product_variant': variant.pk if variant else variant_id,
+            'quantity': 1 if quantity is None else quantity,
+        })
+        guest.apply(operations)
+        guest.save()
+        return self.guest_list(request, guest, status_code)
+
 
 class OrderViewSet(ViewSet, generics.ListAPIView, generics.RetrieveAPIView):
     authentication_classes = (JWTAuthentication, SessionAuthentication)
     permission_classes = (IsAuthenticated, )
-    pagination_class = PageNumberPagination
+    pagination_class = pagination.KeysetPagination
+    keyset_ordering = ('-created_at', 'id')
     serializer_class = serializers.OrderSerializer
 
+    def get_serializer_class(self):
+        if self.action == 'list' and self.request.query_params.get('view') == 'summary':
+            return serializers.OrderSummarySerializer
+        return self.serializer_class
+
     def get_queryset(self):
-        return models.Order.objects.filter(user=self.request.user)
+        # Ordered explicitly, as Meta.ordering does not apply once annotated
+        # with a count.
+        queryset = models.Order.objects.filter(
+            user=self.request.user).order_by(*self.keyset_ordering)
+        fields = serializers.requested_fields(self.request, self.get_serializer_class())
+        if 'item_count' in fields:
+            queryset = queryset.annotate(item_count=Count('items'))
+        for name in ('items', 'statuses'):
+            if name in fields:
+                queryset = queryset.prefetch_related(name)
+        if self.action == 'list':
+            return archive.OrderHistory(
+                queryset,
+                models.ArchivedOrder.objects.filter(user=self.request.user),
+                self.keyset_ordering)
+        return queryset
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            return get_object_or_404(
+                models.ArchivedOrder, user=self.request.user, pk=self.kwargs['pk'])
 
     def create(self, request):
         'Create Order and return payment config'
+        cart = carts.get_cart(request, lines=True)
         serializer = serializers.OrderSerializer(
-            data=request.data, context={'user': request.user})
+            data=request.data, context={'user': request.user, 'cart': cart})
         if serializer.is_valid():
-            cart, _ = models.Cart.objects.get_or_create(user=request.user)
-            serializer.instance.name = cart.address.name
-            serializer.instance.address = cart.address.address
-            serializer.instance.city = cart.address.city
-            serializer.instance.state = cart.address.state
-            serializer.instance.pincode = cart.address.pincode
-            serializer.instance.landmark = cart.address.landmark
-            serializer.instance.phone_number = cart.address.phone_number
-            serializer.instance.alternate_phone_number = cart.address.alternate_phone_number
-            cart_items = models.CartItem.objects.filter(cart=cart)
             serializer.save()
-            total = 0
-            for item in cart_items:
-                total += item.product_variant.price * item.quantity
-                order_item = models.OrderItem(
-                    product_name=item.product_variant.product.name,
-                    variant_name=item.product_variant.name,
-                    product_variant=item.product_variant,
-                    order_id=serializer.instance.id,
-                    quantity=item.quantity,
-                    price=item.product_variant.price,
-                    total=item.product_variant.price * item.quantity
-                )
-                order_item.save()
-            serializer.instance.total = total
-            serializer.instance.save()
-            cart.product_variants.clear()
-            models.OrderStatus.objects.create(
-                order=serializer.instance, status=0)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -202,6 +428,18 @@ class OrderViewSet(ViewSet, generics.ListAPIView, generics.RetrieveAPIView):
         'Return the payment config for the order'
         pass
 
+    @action(detail=False, methods=['post'], url_path='status', permission_classes=[IsAdminUser])
+    def change_status(self, request):
+        '''
+        Moves the given orders of any user to a status, for fulfilment:
+        {"orders": [1, 2, 3], "status": 5}
+        '''
+        serializer = serializers.OrderStatusChangeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        changed, rejected = orders.change_status(
+            serializer.validated_data['orders'], serializer.validated_data['status'])
+        return Response({'changed': changed, 'rejected': rejected})
+
 
 class CouponViewSet(ViewSet):
     queryset = models.Coupon.objects.all()
@@ -211,7 +449,7 @@ class CouponViewSet(ViewSet):
     pagination_class = None
 
     def retrieve(self, request, pk=None):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        cart = carts.get_cart(request, lines=True)
         serializer = serializers.CouponSerializer(
             data={'code': cart.coupon.code if cart.coupon else None}, context={'cart': cart})
         if serializer.is_valid():
@@ -219,20 +457,21 @@ class CouponViewSet(ViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def create(self, request):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        cart = carts.get_cart(request, lines=True)
         serializer = serializers.CouponSerializer(
             data=request.data, context={'cart': cart})
         if serializer.is_valid():
-            cart.coupon = models.Coupon.objects.get(
-                code=serializer.validated_data['code'])
-            cart.save()
+            cart.coupon = serializer.coupon
+            cart.save(update_fields=['coupon'])
+            carts.touch_cart(cart)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def destroy(self, request, pk=None):
-        cart, _ = models.Cart.objects.get_or_create(user=request.user)
+        cart = carts.get_cart(request)
         cart.coupon = None
-        cart.save()
+        cart.save(update_fields=['coupon'])
+        carts.touch_cart(cart)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -246,16 +485,17 @@ class AddressViewSet(ModelViewSet):
         return models.Address.objects.filter(user=self.request.user)
 
     def set_default(self, serializer):
-        cart, _ = models.Cart.objects.get_or_create(user=self.request.user)
+        cart = carts.get_cart(self.request)
         if serializer.instance.selected:
             cart.address = serializer.instance
-            cart.save()
+            cart.save(update_fields=['address'])
         else:
             addresses = models.Address.objects.filter(
                 user=self.request.user, selected=True)
             if not addresses.exists():
                 cart.address = None
-                cart.save()
+                cart.save(update_fields=['address'])
+        carts.touch_cart(cart)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -267,10 +507,11 @@ class AddressViewSet(ModelViewSet):
 
     def perform_destroy(self, instance):
         super().perform_destroy(instance)
-        cart, _ = models.Cart.objects.get_or_create(user=self.request.user)
+        cart = carts.get_cart(self.request)
         if cart.address == instance:
             cart.address = None
-            cart.save()
+            cart.save(update_fields=['address'])
+        carts.touch_cart(cart)
 
 
 class PaymentViewSet(ViewSet):
@@ -281,7 +522,7 @@ class PaymentViewSet(ViewSet):
 
     def list(self, request):
         'This method should return the list of payment methods available with meta data'
-        cart = models.Cart.objects.get(user=request.user)
+        cart = carts.get_cart(request)
         methods = []
         for mode in utils.PAYMENT_MODES:
             methods.append({
@@ -299,11 +540,12 @@ class PaymentViewSet(ViewSet):
 
     def create(self, request):
         'Create a payment for the order'
-        cart = models.Cart.objects.get(user=request.user)
+        cart = carts.get_cart(request)
         serializer = serializers.PaymentSerializer(
             data=request.data, context={'request': request})
         if serializer.is_valid():
             cart.payment_mode = serializer.validated_data['payment_method']
-            cart.save()
+            cart.save(update_fields=['payment_mode'])
+            carts.touch_cart(cart)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
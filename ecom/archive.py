@@ -0,0 +1,170 @@
+import datetime
+from types import SimpleNamespace
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+from . import models
+from .api.pagination import keyset_filter
+
+'''
+Archival of finished orders.
+
+Delivered, cancelled and returned orders older than ECOM_ORDER_ARCHIVE_AGE
+days (365 by default) are moved out of the order, item, status and
+reservation tables into ArchivedOrder, one row per order holding the order
+as the API renders it. The archiveorders command moves them in chunks, each
+in its own transaction, so it can be stopped and run again at any time.
+
+The order API reads through to the archive: a user's order list pages over
+both tables as one (see OrderHistory), and archived orders can be retrieved
+by their id as before.
+'''
+
+ARCHIVED_STATUSES = ['Delivered', 'Cancelled', 'Returned']
+
+
+def get_archive_age():
+    return getattr(settings, 'ECOM_ORDER_ARCHIVE_AGE', 365)
+
+
+def archive_orders(before=None, limit=500):
+    '''
+    Moves up to limit finished orders created before the given time (by
+    default ECOM_ORDER_ARCHIVE_AGE days ago) to the archive. Returns the
+    number of orders moved.
+
+    Orders whose id is already taken in the archive, as when MySQL hands
+    out the ids of archived orders again after a restart, are left alone.
+    '''
+    # Imported here, as the API imports this module.
+    from .api.serializers import OrderSerializer
+
+    if before is None:
+        before = timezone.now() - datetime.timedelta(days=get_archive_age())
+    with transaction.atomic():
+        order_ids = list(models.Order.objects.select_for_update().filter(
+            ~Exists(models.ArchivedOrder.objects.filter(pk=OuterRef('pk'))),
+            status__in=ARCHIVED_STATUSES, created_at__lt=before,
+        ).order_by('pk').values_list('pk', flat=True)[:limit])
+        if not order_ids:
+            return 0
+        orders = models.Order.objects.filter(pk__in=order_ids).annotate(
+            item_count=Count('items')).prefetch_related('items', 'statuses').order_by('pk')
+        models.ArchivedOrder.objects.bulk_create([
+            models.ArchivedOrder(
+                id=order.pk, user_id=order.user_id, created_at=order.created_at,
+                status=order.status, total=order.total, item_count=order.item_count,
+                data=dict(OrderSerializer(order).data))
+            for order in orders
+        ])
+        # Raw deletes, so that the order signals do not run once per row;
+        # the orders are finished, there is no stock or status to update.
+        placeholders = ', '.join(['%s'] * len(order_ids))
+        with connection.cursor() as cursor:
+            for model in (models.OrderItem, models.OrderStatus, models.StockReservation):
+                cursor.execute(
+                    f'DELETE FROM {model._meta.db_table} WHERE order_id IN ({placeholders})',
+                    order_ids)
+            cursor.execute(
+                f'DELETE FROM {models.Order._meta.db_table} WHERE id IN ({placeholders})',
+                order_ids)
+    return len(order_ids)
+
+
+def sort_by(instances, ordering):
+    '''
+    Sorts instances on fields like queryset.order_by(), with stable sorts
+    from the last field to the first.
+    '''
+    for field in reversed(ordering):
+        instances.sort(
+            key=lambda instance: getattr(instance, field.lstrip('-')),
+            reverse=field.startswith('-'))
+    return instances
+
+
+class OrderHistory:
+    '''
+    The orders of a user in the order table and in the archive, ordered,
+    filtered, counted and sliced like a single queryset, for the paginators.
+    A slice holds Order and ArchivedOrder instances.
+    '''
+    ordered = True
+
+    def __init__(self, orders, archived, ordering):
+        self.model = orders.model
+        self.orders = orders
+        self.archived = archived
+        self.ordering = list(ordering)
+
+    def order_by(self, *ordering):
+        return OrderHistory(
+            self.orders.order_by(*ordering), self.archived.order_by(*ordering), ordering)
+
+    def filter(self, *args, **kwargs):
+        return OrderHistory(
+            self.orders.filter(*args, **kwargs), self.archived.filter(*args, **kwargs),
+            self.ordering)
+
+    def count(self):
+        return self.orders.count() + self.archived.count()
+
+    def __len__(self):
+        return self.count()
+
+    def keys(self, queryset, archived):
+        names = [field.lstrip('-') for field in self.ordering]
+        return [
+            SimpleNamespace(archived=archived, **dict(zip(['pk'] + names, row)))
+            for row in queryset.values_list('pk', *names)
+        ]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        # Merges the keys first, and only loads the rows of the slice.
+        if start:
+            keys = self.slice_keys(start, stop)
+        else:
+            # The first rows of both tables, all that cursor pages read.
+            keys = sort_by(
+                self.keys(self.orders[:stop], False) + self.keys(self.archived[:stop], True),
+                self.ordering)[:stop]
+        orders = self.orders.in_bulk([key.pk for key in keys if not key.archived])
+        archived = self.archived.in_bulk([key.pk for key in keys if key.archived])
+        return [(archived if key.archived else orders)[key.pk] for key in keys]
+
+    def slice_keys(self, start, stop):
+        '''
+        The keys of the rows from start to stop, without reading the rows
+        before start. The orders sorting before the first archived order
+        come first and are sliced on their own; only the orders sorting
+        after it, unfinished orders as old as the archived ones, which are
+        few, are merged with a slice of the archive.
+        '''
+        first = self.keys(self.archived[:1], True)
+        if not first:
+            return self.keys(self.orders[start:stop], False)
+        boundary = [getattr(first[0], field.lstrip('-')) for field in self.ordering]
+        head = self.orders.filter(keyset_filter(self.ordering, boundary, reverse=True))
+        keys = self.keys(head[start:stop], False)
+        if len(keys) == stop - start:
+            return keys
+        head_count = start + len(keys) if keys else head.count()
+        start, stop = max(start - head_count, 0), stop - head_count
+        tail = self.keys(self.orders.filter(keyset_filter(self.ordering, boundary)), False)
+        # At most len(tail) orders come before row start of the archive.
+        offset = max(start - len(tail), 0)
+        window = self.keys(self.archived[offset:stop], True)
+        if not window:
+            return keys
+        merged = sort_by(tail + window, self.ordering)
+        position = 0
+        if offset:
+            # Drops the orders before the window, whose rows are not read.
+            skipped = merged.index(window[0])
+            merged, position = merged[skipped:], offset + skipped
+        return keys + merged[start - position:stop - position]
+
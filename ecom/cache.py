@@ -0,0 +1,187 @@
+import time
+import hashlib
+from django.core.cache import cache
+from django.db import connection, transaction
+from .utils import on_commit_batch
+
+'''
+The catalog version changes whenever a product, variant, image or category is
+saved or deleted. Everything cached from the catalog is stored together with
+the version it was built from, so a bump invalidates all of it at once.
+
+Orders change the stock many times more often, and the stock is only shown
+through the in_stock filter and facets, so it has a version of its own that
+only what depends on it is keyed with.
+'''
+
+CATALOG_VERSION_KEY = 'ecom:catalog:version'
+STOCK_VERSION_KEY = 'ecom:stock:version'
+CATALOG_SNAPSHOT_TIMEOUT = 60 * 60 * 24
+SNAPSHOT_LOCK_TIMEOUT = 30
+SNAPSHOT_WAIT_TIMEOUT = 5
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Versions are millisecond timestamps, so a version lost with the
+        # cache is never handed out again for different data.
+        version = _now_ms()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    version = max(_now_ms(), (cache.get(key) or 0) + 1)
+    cache.set(key, version, None)
+    return version
+
+
+def catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    return bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_versions(keys):
+    for key in keys:
+        bump_version(key)
+
+
+def invalidate_catalog():
+    '''
+    Bumps the catalog version once the current transaction commits, so that
+    no worker can rebuild a snapshot from data that is about to change, and
+    only once however many rows the transaction saved.
+    '''
+    on_commit_batch(bump_versions, [CATALOG_VERSION_KEY])
+
+
+def stock_version():
+    return get_version(STOCK_VERSION_KEY)
+
+
+def invalidate_stock():
+    'Bumps the stock version once the current transaction commits'
+    on_commit_batch(bump_versions, [STOCK_VERSION_KEY])
+
+
+def whishlist_version(user_id):
+    '''
+    The version of the data that depends on the products a user whishlisted.
+    '''
+    return get_version(f'ecom:whishlist:version:{user_id}')
+
+
+def invalidate_whishlist(user_id):
+    transaction.on_commit(
+        lambda: bump_version(f'ecom:whishlist:version:{user_id}'))
+
+
+def product_versions(product_ids):
+    '''
+    Returns the version of each product, used to key the cached fragments
+    that render a single product.
+    '''
+    keys = {f'ecom:product:version:{product_id}': product_id for product_id in product_ids}
+    versions = cache.get_many(keys)
+    missing = {key: _now_ms() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def bump_product_versions(product_ids):
+    for product_id in product_ids:
+        bump_version(f'ecom:product:version:{product_id}')
+
+
+def invalidate_products(product_ids):
+    on_commit_batch(bump_product_versions, product_ids)
+
+
+def acquire_lock(key):
+    '''
+    Takes the lock named key without waiting. Returns a function releasing
+    it, or None when another worker holds it.
+
+    On MySQL and PostgreSQL this is an advisory lock of the database, as
+    cache.add() is not atomic on every cache backend: the file based one
+    checks for the key and writes it in two steps. Elsewhere it falls back
+    to cache.add(), which is atomic for the local memory cache of a single
+    process, memcached and Redis only.
+    '''
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    if connection.vendor == 'mysql':
+        # Lock names are limited to 64 characters.
+        name = f'ecom:{digest}'
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT GET_LOCK(%s, 0)', [name])
+            if cursor.fetchone()[0] != 1:
+                return None
+
+        def release():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT RELEASE_LOCK(%s)', [name])
+        return release
+    if connection.vendor == 'postgresql':
+        number = int(digest[:15], 16)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [number])
+            if not cursor.fetchone()[0]:
+                return None
+
+        def release():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [number])
+        return release
+    if not cache.add(key, True, SNAPSHOT_LOCK_TIMEOUT):
+        return None
+    return lambda: cache.delete(key)
+
+
+def get_catalog_snapshot(name, build, timeout=CATALOG_SNAPSHOT_TIMEOUT, stock=False):
+    '''
+    Returns the snapshot stored under name for the current catalog version,
+    and stock version with stock, calling build() to create it when it is
+    missing or stale.
+
+    Only the worker holding the rebuild lock calls build(). The others keep
+    serving the previous snapshot until the new one is stored, or wait for
+    it when there is nothing to serve yet.
+    '''
+    version = catalog_version()
+    if stock:
+        version = f'{version}-{stock_version()}'
+    key = f'ecom:catalog:snapshot:{name}'
+    entry = cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    release = acquire_lock(f'{key}:lock:{version}')
+    if release is not None:
+        try:
+            data = build()
+            cache.set(key, (version, data), timeout)
+        finally:
+            release()
+        return data
+
+    if entry is not None:
+        return entry[1]
+
+    deadline = time.monotonic() + SNAPSHOT_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+    return build()
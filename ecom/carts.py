@@ -0,0 +1,469 @@
+import uuid
+import datetime
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F, Prefetch, Q, prefetch_related_objects
+from django.utils import timezone
+from . import models
+from .cache import catalog_version
+from .managers import cart_lines
+from .utils import CartPricing, on_commit_batch
+
+'''
+Cart lines, and the carts of visitors who have not logged in ("guest carts").
+
+A guest cart is stored under a random token, which the client keeps either
+in a signed cookie or as the signed X-Cart-Token header, in the Cart and
+CartItem tables (with Cart.guest_token set and no user), where it is written
+on every change. On login the guest cart is merged into the user's cart.
+
+With ECOM_GUEST_CART_CACHE set to the alias of a cache that never evicts the
+carts before they are written, like Redis, cart requests of guests only touch
+that cache, and the carts are written behind and read back from the database
+when the cache has lost them. The file based cache is not fit for it: it
+evicts entries at random once full and lists its directory on every write.
+The first change after a write marks the Cart row as pending, and the
+persistguestcarts command, run every minute (from cron), writes the carts
+that have been pending for ECOM_GUEST_CART_WRITE_DELAY seconds with every
+change made in the meantime. As the mark is in the database, no write is
+lost when a web process exits. A delay of 0 writes the cart on every change.
+
+Guest carts that were not written for GUEST_CART_TIMEOUT are deleted by the
+purgeguestcarts command.
+
+The carts of users are created with the user (or on login, for users that
+predate this) and looked up once per request through get_cart().
+'''
+
+GUEST_CART_COOKIE = 'cart_token'
+GUEST_CART_HEADER = 'X-Cart-Token'
+GUEST_CART_SALT = 'ecom.guest-cart'
+GUEST_CART_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def ensure_cart(user):
+    '''
+    The cart of user, with its address and coupon, created if it does not
+    exist yet. Safe against concurrent requests creating it.
+    '''
+    carts = models.Cart.objects.select_related('address', 'coupon')
+    try:
+        return carts.get(user=user)
+    except models.Cart.DoesNotExist:
+        pass
+    try:
+        with transaction.atomic():
+            models.Cart.objects.create(user=user)
+    except IntegrityError:
+        # Created by a concurrent request in the meantime.
+        pass
+    return carts.get(user=user)
+
+
+def get_cart(request, lines=False, images=False):
+    '''
+    The cart of the user of the request, looked up once per request.
+
+    With lines the lines (with their variants and products) are loaded too,
+    freshly on every call, and with images the cover images of the products.
+    '''
+    request = getattr(request, '_request', request)
+    cart = getattr(request, '_ecom_cart', None)
+    if cart is None or cart.user_id != request.user.pk:
+        cart = request._ecom_cart = ensure_cart(request.user)
+    if lines:
+        cart._prefetched_objects_cache = {}
+        cart._pricing = None
+        prefetch_related_objects([cart], cart_lines(images=images))
+    return cart
+
+
+REMOVED_LINES_LIMIT = 200
+
+
+def touch_cart(cart, changed=(), removed=(), full=False):
+    '''
+    Bumps the version of a cart (an instance or an id) and records the
+    variants whose lines changed or were removed in that version, which
+    lets polling clients fetch only what changed since the version they
+    have. With full, or when too many removals are recorded, changes before
+    this version are no longer listed and such clients get the whole cart.
+    Returns the new version.
+    '''
+    cart_id = getattr(cart, 'pk', cart)
+    changed, removed = set(changed), set(removed)
+    with transaction.atomic():
+        state = models.Cart.objects.select_for_update().filter(
+            pk=cart_id).values('version', 'removed_lines', 'delta_base').first()
+        if state is None:
+            return None
+        version = state['version'] + 1
+        removed_lines = state['removed_lines']
+        delta_base = state['delta_base']
+        for variant_id in removed - changed:
+            removed_lines[str(variant_id)] = version
+        for variant_id in changed:
+            removed_lines.pop(str(variant_id), None)
+        if full or len(removed_lines) > REMOVED_LINES_LIMIT:
+            removed_lines, delta_base = {}, version
+        models.Cart.objects.filter(pk=cart_id).update(
+            version=version, removed_lines=removed_lines, delta_base=delta_base)
+        if changed:
+            models.CartItem.objects.filter(
+                cart_id=cart_id, product_variant_id__in=changed).update(version=version)
+    if isinstance(cart, models.Cart):
+        cart.version, cart.removed_lines, cart.delta_base = version, removed_lines, delta_base
+    return version
+
+
+def remove_lines(lines):
+    '''
+    Deletes a queryset of cart lines of any number of carts, bumping the
+    versions of their carts in one update. The removals are not recorded
+    per variant, so clients polling those carts get the whole cart again.
+    '''
+    cart_ids = set(lines.values_list('cart_id', flat=True))
+    if cart_ids:
+        lines.delete()
+        models.Cart.objects.filter(pk__in=cart_ids).update(
+            version=F('version') + 1, delta_base=F('version') + 1, removed_lines={})
+
+
+def sweep_unavailable(product_ids=None):
+    '''
+    Marks the variants of unavailable products unavailable and removes the
+    lines of unavailable variants from every cart, in a handful of queries
+    whatever the number of products. product_ids limits the sweep to those
+    products, None sweeps the whole catalog.
+
+    Saving products and variants schedules this through schedule_sweep().
+    Code changing availability without the signals, with a queryset
+    update() or bulk_update(), has to call it itself.
+    '''
+    variants = models.ProductVariant.objects.all()
+    if product_ids is not None:
+        variants = variants.filter(product__in=list(product_ids))
+    with transaction.atomic():
+        variants.filter(product__available=False, available=True).update(available=False)
+        remove_lines(models.CartItem.objects.filter(
+            product_variant__in=variants.filter(available=False)))
+
+
+def schedule_sweep(product_ids):
+    '''
+    Sweeps the carts for product_ids once the current transaction commits,
+    together with every other product scheduled in that transaction.
+    '''
+    on_commit_batch(sweep_unavailable, product_ids)
+
+
+def version_token(cart):
+    '''
+    The version of a cart as handed to clients, which also changes with the
+    catalog, as prices and availability come from there.
+    '''
+    if cart.pk is None:
+        return None
+    return f'{cart.version}-{catalog_version()}'
+
+
+def parse_version_token(cart, token):
+    '''
+    The cart version a client sent with ?since=, or None when the changes
+    since then cannot be listed and the whole cart has to be sent.
+    '''
+    try:
+        version, catalog = map(int, token.split('-'))
+    except (AttributeError, ValueError):
+        return None
+    if catalog != catalog_version() or not cart.delta_base <= version <= cart.version:
+        return None
+    return version
+
+
+def apply_operations(quantities, operations):
+    '''
+    Applies add, set and remove operations to a {variant id: quantity}
+    dict. Removed variants are kept with a quantity of None.
+    '''
+    quantities = dict(quantities)
+    for operation in operations:
+        variant_id = operation['product_variant']
+        if operation['op'] == 'remove':
+            quantities[variant_id] = None
+        elif operation['op'] == 'add':
+            quantities[variant_id] = (
+                quantities.get(variant_id) or 0) + operation.get('quantity', 1)
+        else:
+            quantities[variant_id] = operation['quantity']
+    return quantities
+
+
+def sync_lines(cart, quantities, lines):
+    '''
+    Makes the lines of a cart match {variant id: quantity}, where lines are
+    the existing lines of those variants by variant id and a quantity of
+    None removes the line, with one delete, one insert and one update.
+    Lines inserted by a concurrent request after lines were read take the
+    quantity given here instead of failing on the unique constraint.
+    '''
+    created, updated, removed = [], [], []
+    for variant_id, quantity in quantities.items():
+        line = lines.get(variant_id)
+        if quantity is None:
+            if line:
+                removed.append(variant_id)
+        elif line is None:
+            created.append(models.CartItem(
+                cart=cart, product_variant_id=variant_id, quantity=quantity))
+        elif line.quantity != quantity:
+            line.quantity = quantity
+            updated.append(line)
+    if removed:
+        models.CartItem.objects.filter(
+            cart=cart, product_variant_id__in=removed).delete()
+    models.CartItem.objects.bulk_create(
+        created, update_conflicts=True, unique_fields=['cart', 'product_variant'],
+        update_fields=['quantity'])
+    models.CartItem.objects.bulk_update(updated, ['quantity'])
+    if created or updated or removed:
+        touch_cart(cart, changed=[
+            line.product_variant_id for line in created + updated], removed=removed)
+
+
+def get_write_delay():
+    return getattr(settings, 'ECOM_GUEST_CART_WRITE_DELAY', 5)
+
+
+def get_cart_cache():
+    '''
+    The cache guest carts are written behind from, or None when they are
+    written to the database on every change.
+    '''
+    alias = getattr(settings, 'ECOM_GUEST_CART_CACHE', None)
+    return caches[alias] if alias else None
+
+
+class GuestCart:
+    def __init__(self, token, items=None):
+        self.token = token
+        self.items = items or {}
+
+    @property
+    def key(self):
+        return f'ecom:guest-cart:{self.token}'
+
+    @classmethod
+    def from_request(cls, request):
+        '''
+        The guest cart of the request, or a new empty one (with a new token)
+        when the request has no valid token.
+        '''
+        token = read_token(request)
+        if token is None:
+            return cls(uuid.uuid4().hex)
+        return cls.load(token)
+
+    @classmethod
+    def load(cls, token):
+        cart = cls(token)
+        cart_cache = get_cart_cache()
+        items = cart_cache.get(cart.key) if cart_cache else None
+        if items is None:
+            items = dict(models.CartItem.objects.filter(
+                cart__guest_token=token, cart__user__isnull=True
+            ).values_list('product_variant_id', 'quantity'))
+            if cart_cache:
+                cart_cache.set(cart.key, items, GUEST_CART_TIMEOUT)
+        cart.items = items
+        return cart
+
+    def apply(self, operations):
+        quantities = apply_operations(self.items, operations)
+        self.items = {
+            variant_id: quantity for variant_id, quantity in quantities.items()
+            if quantity is not None
+        }
+
+    def save(self):
+        cart_cache = get_cart_cache()
+        if cart_cache is None:
+            persist(self.token, self.items)
+            return
+        cart_cache.set(self.key, self.items, GUEST_CART_TIMEOUT)
+        if not get_write_delay():
+            persist(self.token, self.items)
+        elif cart_cache.add(f'{self.key}:pending', True, None):
+            # Only the first change after a write marks the cart; the write
+            # picks up every change made in the meantime.
+            try:
+                mark_pending(self.token)
+            except Exception:
+                cart_cache.delete(f'{self.key}:pending')
+                raise
+
+    def delete(self):
+        cart_cache = get_cart_cache()
+        if cart_cache:
+            cart_cache.delete_many([self.key, f'{self.key}:pending'])
+        models.Cart.objects.filter(guest_token=self.token, user__isnull=True).delete()
+
+    def as_cart(self):
+        '''
+        An unsaved Cart holding the lines of the guest cart, for the cart
+        serializers. Variants that no longer exist or are unavailable are
+        left out, as they are removed from the carts of users.
+        '''
+        cart = models.Cart(guest_token=self.token)
+        variants = models.ProductVariant.objects.filter(
+            pk__in=self.items, available=True
+        ).select_related('product').prefetch_related(
+            Prefetch(
+                'product__productimage_set',
+                queryset=models.ProductImage.objects.select_related(
+                    'image').order_by('sort_order', 'id')[:1],
+                to_attr='cover_images'),
+        ).in_bulk() if self.items else {}
+        cart._pricing = CartPricing(cart, [
+            models.CartItem(product_variant=variants[variant_id], quantity=quantity)
+            for variant_id, quantity in self.items.items() if variant_id in variants
+        ])
+        return cart
+
+    def set_token(self, response):
+        'Hands the token to the client in a cookie and a header'
+        response.set_signed_cookie(
+            GUEST_CART_COOKIE, self.token, salt=GUEST_CART_SALT,
+            max_age=GUEST_CART_TIMEOUT, httponly=True, samesite='Lax')
+        response.headers[GUEST_CART_HEADER] = signing.dumps(
+            self.token, salt=GUEST_CART_SALT)
+        return response
+
+
+def read_token(request):
+    value = request.headers.get(GUEST_CART_HEADER)
+    if value:
+        try:
+            return signing.loads(value, salt=GUEST_CART_SALT, max_age=GUEST_CART_TIMEOUT)
+        except signing.BadSignature:
+            return None
+    return request.get_signed_cookie(
+        GUEST_CART_COOKIE, default=None, salt=GUEST_CART_SALT, max_age=GUEST_CART_TIMEOUT)
+
+
+def persist(token, items=None):
+    '''
+    Writes the guest cart of token to the database, with the given
+    {variant id: quantity} items or else the cached ones.
+    '''
+    if items is None:
+        cart_cache = get_cart_cache()
+        items = cart_cache.get(f'ecom:guest-cart:{token}') if cart_cache else None
+        if items is None:
+            return
+    with transaction.atomic():
+        cart, _ = models.Cart.objects.get_or_create(guest_token=token)
+        models.Cart.objects.filter(pk=cart.pk).update(written_at=timezone.now())
+        lines = {
+            line.product_variant_id: line
+            for line in models.CartItem.objects.select_for_update().filter(cart=cart)
+        }
+        quantities = {variant_id: None for variant_id in lines}
+        quantities.update(items)
+        existing = set(models.ProductVariant.objects.filter(
+            pk__in=items).values_list('pk', flat=True))
+        for variant_id in set(items) - existing:
+            quantities[variant_id] = None
+        sync_lines(cart, quantities, lines)
+
+
+def mark_pending(token):
+    '''
+    Records that the guest cart of token has changes to write.
+    '''
+    now = timezone.now()
+    carts = models.Cart.objects.filter(guest_token=token, user__isnull=True)
+    if carts.update(pending_since=now):
+        return
+    try:
+        with transaction.atomic():
+            models.Cart.objects.create(guest_token=token, pending_since=now, written_at=now)
+    except IntegrityError:
+        # Created by a concurrent request in the meantime.
+        carts.update(pending_since=now)
+
+
+def persist_pending(before=None, limit=500):
+    '''
+    Writes up to limit guest carts that have been pending since before (by
+    default ECOM_GUEST_CART_WRITE_DELAY seconds ago). Returns the number of
+    carts written.
+    '''
+    if before is None:
+        before = timezone.now() - datetime.timedelta(seconds=get_write_delay())
+    cart_cache = get_cart_cache()
+    pending = list(models.Cart.objects.filter(
+        pending_since__lte=before, user__isnull=True
+    ).order_by('pending_since').values_list('pk', 'guest_token', 'pending_since')[:limit])
+    for cart_id, token, pending_since in pending:
+        # Unmarked before the cart is read from the cache, and only when no
+        # change marked it again meanwhile, so a change made during the
+        # write marks it for the next one.
+        if cart_cache:
+            cart_cache.delete(f'ecom:guest-cart:{token}:pending')
+        models.Cart.objects.filter(
+            pk=cart_id, pending_since=pending_since).update(pending_since=None)
+        try:
+            persist(token)
+        except Exception:
+            mark_pending(token)
+            raise
+    return len(pending)
+
+
+def purge_guest_carts(before=None, limit=500):
+    '''
+    Deletes up to limit guest carts that were last written before the given
+    time (by default GUEST_CART_TIMEOUT ago, when their tokens have expired)
+    and have no pending changes, along with the guest carts written before
+    written_at was recorded. Returns the number of carts deleted.
+    '''
+    if before is None:
+        before = timezone.now() - datetime.timedelta(seconds=GUEST_CART_TIMEOUT)
+    cart_ids = list(models.Cart.objects.filter(
+        Q(written_at__lt=before) | Q(written_at__isnull=True),
+        guest_token__isnull=False, pending_since__isnull=True, user__isnull=True,
+    ).order_by('written_at').values_list('pk', flat=True)[:limit])
+    if cart_ids:
+        models.Cart.objects.filter(pk__in=cart_ids).delete()
+    return len(cart_ids)
+
+
+def merge_guest_cart(request, user):
+    '''
+    Moves the guest cart of the request into the cart of user. For variants
+    in both carts the larger quantity is kept. Returns whether there was a
+    guest cart.
+    '''
+    token = read_token(request)
+    if token is None:
+        return False
+    guest = GuestCart.load(token)
+    if guest.items:
+        cart = ensure_cart(user)
+        with transaction.atomic():
+            lines = {
+                line.product_variant_id: line
+                for line in models.CartItem.objects.select_for_update().filter(
+                    cart=cart, product_variant_id__in=guest.items)
+            }
+            existing = set(models.ProductVariant.objects.filter(
+                pk__in=guest.items).values_list('pk', flat=True))
+            sync_lines(cart, {
+                variant_id: max(quantity, lines[variant_id].quantity if variant_id in lines else 0)
+                for variant_id, quantity in guest.items.items() if variant_id in existing
+            }, lines)
+    guest.delete()
+    return True
@@ -0,0 +1,199 @@
+import io
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image as PILImage, ImageOps
+
+'''
+Resized copies ("derivatives") of the uploaded images, in JPEG and WebP.
+
+The resizing runs in a pool of worker processes, which only receive the
+original bytes and return the encoded derivatives, so this module must not
+import the models at import time. The derivatives are stored under the hash
+of the original content, and an image whose content hash has not changed is
+not processed again.
+
+Uploads are processed inline once they are committed, unless
+ECOM_IMAGE_WORKERS sets the size of a pool for them. It is 0 by default, as
+the pool spawns sys.executable, which is not a Python interpreter under
+mod_wsgi. The processimages command runs its own pool (--workers).
+'''
+
+IMAGE_SIZES = {
+    'thumb': 160,
+    'card': 480,
+    'detail': 1200,
+}
+IMAGE_FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+}
+DERIVATIVES_PATH = 'images/derivatives'
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def render_derivatives(data: bytes):
+    '''
+    Returns {size: {'width': ..., 'height': ..., format: bytes}} for the image
+    in data. Runs in the worker processes.
+    '''
+    with PILImage.open(io.BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode in ('RGBA', 'LA', 'P'):
+            original = original.convert('RGBA')
+            background = PILImage.new('RGB', original.size, (255, 255, 255))
+            background.paste(original, mask=original.getchannel('A'))
+            original = background
+        elif original.mode != 'RGB':
+            original = original.convert('RGB')
+
+        result = {}
+        for size, edge in IMAGE_SIZES.items():
+            resized = original.copy()
+            resized.thumbnail((edge, edge), PILImage.LANCZOS)
+            rendered = {'width': resized.width, 'height': resized.height}
+            for name, (pil_format, _, options) in IMAGE_FORMATS.items():
+                buffer = io.BytesIO()
+                resized.save(buffer, pil_format, **options)
+                rendered[name] = buffer.getvalue()
+            result[size] = rendered
+        return result
+
+
+def read_image(image):
+    image.image.open('rb')
+    try:
+        return image.image.read()
+    finally:
+        image.image.close()
+
+
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def needs_processing(image, digest):
+    return image.content_hash != digest or not image.derivatives
+
+
+def store_derivatives(image_id, digest, rendered):
+    '''
+    Saves the rendered derivatives and records them on the image.
+    '''
+    from . import models
+    from .cache import invalidate_catalog, invalidate_products
+
+    derivatives = {}
+    for size, files in rendered.items():
+        derivatives[size] = {'width': files['width'], 'height': files['height']}
+        for name, (_, extension, _) in IMAGE_FORMATS.items():
+            path = f'{DERIVATIVES_PATH}/{digest[:2]}/{digest}/{size}.{extension}'
+            if not default_storage.exists(path):
+                path = default_storage.save(path, ContentFile(files[name]))
+            derivatives[size][name] = path
+
+    # A queryset update, so that saving the derivatives does not trigger
+    # another round of processing through the post_save signal.
+    models.Image.objects.filter(pk=image_id).update(
+        content_hash=digest, derivatives=derivatives)
+    invalidate_products(models.ProductImage.objects.filter(
+        image_id=image_id).values_list('product_id', flat=True))
+    invalidate_catalog()
+    return derivatives
+
+
+def create_executor(workers):
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = create_executor(get_worker_count())
+    return _executor
+
+
+def get_worker_count():
+    return getattr(settings, 'ECOM_IMAGE_WORKERS', 0)
+
+
+def process_image(image, force=False):
+    '''
+    Creates the derivatives of an image unless its content is unchanged.
+    With workers configured the resizing runs in the pool, and the result is
+    stored from a callback. Returns False when skipped.
+    '''
+    data = read_image(image)
+    digest = content_hash(data)
+    if not force and not needs_processing(image, digest):
+        return False
+
+    if not get_worker_count():
+        store_derivatives(image.pk, digest, render_derivatives(data))
+        return True
+
+    future = get_executor().submit(render_derivatives, data)
+    caller = threading.current_thread()
+
+    def done(future):
+        try:
+            store_derivatives(image.pk, digest, future.result())
+        except Exception:
+            logger.exception('Could not process image %s', image.pk)
+        finally:
+            # A future that is already done runs the callback right away in
+            # this thread, whose connections are not ours to close.
+            if threading.current_thread() is not caller:
+                connections.close_all()
+
+    future.add_done_callback(done)
+    return True
+
+
+def schedule_processing(image):
+    def process():
+        try:
+            process_image(image)
+        except Exception:
+            # The upload itself has been saved; processimages can retry it.
+            logger.exception('Could not process image %s', image.pk)
+
+    transaction.on_commit(process)
+
+
+def image_sources(image, request):
+    '''
+    The URLs of the derivatives of an image, per size and format, along with
+    srcset strings per format. None when the image has no derivatives yet.
+    '''
+    if not image or not image.derivatives:
+        return None
+
+    def url(path):
+        url = default_storage.url(path)
+        return request.build_absolute_uri(url) if request else url
+
+    sizes = {}
+    srcset = {name: [] for name in IMAGE_FORMATS}
+    for size, files in image.derivatives.items():
+        sizes[size] = {'width': files['width'], 'height': files['height']}
+        for name in IMAGE_FORMATS:
+            sizes[size][name] = url(files[name])
+            srcset[name].append(f"{sizes[size][name]} {files['width']}w")
+    return {
+        'sizes': sizes,
+        'srcset': {name: ', '.join(urls) for name, urls in srcset.items()},
+    }
@@ -0,0 +1,160 @@
+import datetime
+import operator
+from functools import reduce
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, When
+from django.utils import timezone
+from rest_framework.serializers import ValidationError
+from . import models
+from .cache import invalidate_products, invalidate_stock
+
+'''
+Stock reservations.
+
+ProductVariant.stock is the stock that can still be sold. Placing an order
+takes the stock of its lines right away, with conditional updates that never
+take it below zero, and records it as held by the order. Paying for the order
+commits the reservation; cancelling or returning it, or leaving it unpaid
+until the reservation expires, puts the stock back. Stock changes are bulk
+updates that send no signals, so they bump the stock version, which the
+stock filter and facets depend on, and the versions of their products
+themselves. The rest of the cached catalog does not depend on the stock.
+
+The variant rows are locked in the order of their ids, so concurrent
+checkouts of the same variants wait for each other instead of deadlocking,
+and the stock of all the variants of an order is taken by one conditional
+update.
+
+ECOM_RESERVATION_TIMEOUT sets how long in seconds an unpaid order holds its
+stock; the expirereservations command cancels the orders past it.
+'''
+
+PENDING = models.STATUS_CHOICES.index('Pending')
+PAID = models.STATUS_CHOICES.index('Paid')
+CANCELLED = models.STATUS_CHOICES.index('Cancelled')
+RELEASING_STATUSES = (CANCELLED, models.STATUS_CHOICES.index('Returned'))
+
+
+class OutOfStock(ValidationError):
+    def __init__(self, variants):
+        self.variant_ids = [variant.pk for variant in variants]
+        super().__init__({'products': [
+            f'Only {max(variant.stock, 0)} left of {variant}' if variant.available
+            else f'{variant} is not available'
+            for variant in variants
+        ]})
+
+
+def get_reservation_timeout():
+    return getattr(settings, 'ECOM_RESERVATION_TIMEOUT', 30 * 60)
+
+
+def reserve(order, quantities):
+    '''
+    Takes the stock of {variant id: quantity} for order, with one update
+    whatever the number of variants. Raises OutOfStock, taking nothing, when
+    any variant is unavailable or short of stock.
+    '''
+    variant_ids = sorted(quantities)
+    with transaction.atomic():
+        # Locks the rows in id order first, where the update alone would
+        # lock them in whatever order the database scans them.
+        product_ids = set(models.ProductVariant.objects.select_for_update().filter(
+            pk__in=variant_ids).order_by('pk').values_list('product_id', flat=True))
+        taken = models.ProductVariant.objects.filter(
+            reduce(operator.or_, [
+                Q(pk=variant_id, stock__gte=quantities[variant_id]) for variant_id in variant_ids]),
+            available=True,
+        ).update(stock=Case(
+            *[When(pk=variant_id, then=F('stock') - quantities[variant_id])
+              for variant_id in variant_ids],
+            output_field=IntegerField(),
+        ))
+        if taken == len(variant_ids):
+            invalidate_products(product_ids)
+            invalidate_stock()
+            expires_at = timezone.now() + datetime.timedelta(seconds=get_reservation_timeout())
+            return models.StockReservation.objects.bulk_create([
+                models.StockReservation(
+                    order=order, product_variant_id=variant_id,
+                    quantity=quantities[variant_id], expires_at=expires_at)
+                for variant_id in variant_ids
+            ])
+        # Puts back the stock taken from the other variants.
+        transaction.set_rollback(True)
+    raise OutOfStock([
+        variant for variant in models.ProductVariant.objects.filter(
+            pk__in=variant_ids).select_related('product')
+        if not variant.available or variant.stock < quantities[variant.pk]
+    ])
+
+
+def commit(order_ids):
+    '''
+    Keeps the stock held by orders for good, once they are paid.
+    '''
+    return models.StockReservation.objects.filter(
+        order_id__in=order_ids, state=models.StockReservation.HELD
+    ).update(state=models.StockReservation.COMMITTED)
+
+
+def release(order_ids, states=(models.StockReservation.HELD, models.StockReservation.COMMITTED)):
+    '''
+    Puts the stock reserved by orders back, once per reservation however
+    often it is called. Returns the number of released reservations.
+    '''
+    with transaction.atomic():
+        reservations = list(models.StockReservation.objects.select_for_update().filter(
+            order_id__in=order_ids, state__in=states
+        ).order_by('pk').values_list(
+            'pk', 'product_variant_id', 'product_variant__product_id', 'quantity'))
+        quantities = {}
+        for _, variant_id, _, quantity in reservations:
+            quantities[variant_id] = quantities.get(variant_id, 0) + quantity
+        for variant_id in sorted(quantities):
+            models.ProductVariant.objects.filter(pk=variant_id).update(
+                stock=F('stock') + quantities[variant_id])
+        if reservations:
+            invalidate_products({reservation[2] for reservation in reservations})
+            invalidate_stock()
+        models.StockReservation.objects.filter(
+            pk__in=[reservation[0] for reservation in reservations]
+        ).update(state=models.StockReservation.RELEASED)
+    return len(reservations)
+
+
+def status_changed(order_ids, status):
+    '''
+    Commits or releases the stock of orders that moved to status.
+    '''
+    if status == PAID:
+        commit(order_ids)
+    elif status in RELEASING_STATUSES:
+        release(order_ids)
+
+
+def expire_reservations(now=None, limit=500):
+    '''
+    Cancels up to limit unpaid orders whose reservations have expired,
+    putting their stock back. Returns the ids of the cancelled orders.
+    '''
+    now = now or timezone.now()
+    with transaction.atomic():
+        expired = set(models.StockReservation.objects.filter(
+            state=models.StockReservation.HELD, expires_at__lte=now,
+            order__status=models.STATUS_CHOICES[PENDING],
+        ).values_list('order_id', flat=True)[:limit])
+        # Locking the orders keeps a payment from slipping in meanwhile.
+        order_ids = list(models.Order.objects.select_for_update().filter(
+            pk__in=expired, status=models.STATUS_CHOICES[PENDING]
+        ).order_by('pk').values_list('pk', flat=True))
+        if order_ids:
+            release(order_ids)
+            models.OrderStatus.objects.bulk_create([
+                models.OrderStatus(order_id=order_id, status=CANCELLED)
+                for order_id in order_ids
+            ])
+            models.Order.objects.filter(pk__in=order_ids).update(
+                status=models.STATUS_CHOICES[CANCELLED])
+    return order_ids
@@ -0,0 +1,31 @@
+import time
+import datetime
+from ecom import archive
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Moves finished orders older than ECOM_ORDER_ARCHIVE_AGE days to the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, help='Archive orders older than this instead')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else archive.get_archive_age()
+        before = timezone.now() - datetime.timedelta(days=days)
+        start = time.perf_counter()
+        total = 0
+        while True:
+            # Every chunk is committed on its own, so an interrupted run
+            # carries on from there when started again.
+            moved = archive.archive_orders(before, limit=options['chunk_size'])
+            if not moved:
+                break
+            total += moved
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{total} orders archived')
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total} orders in {time.perf_counter() - start:.2f}s'))
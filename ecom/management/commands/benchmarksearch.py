@@ -0,0 +1,108 @@
+import random
+import time
+from ecom import models
+from ecom import search
+from ecom.api.filters import ProductSearchFilter
+from django.db import DEFAULT_DB_ALIAS
+from django.test import RequestFactory
+from django.test.utils import setup_databases, teardown_databases
+from django.core.management.base import BaseCommand
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+
+SYLLABLES = ['ka', 'ri', 'to', 'ne', 'su', 'mo', 'la', 'vi', 'de', 'pa', 'ro', 'chi']
+WORDS = [
+    'cotton', 'silk', 'linen', 'wool', 'denim', 'leather', 'shirt', 'kurta',
+    'saree', 'dupatta', 'trouser', 'jacket', 'scarf', 'stole', 'bag', 'wallet',
+    'red', 'blue', 'green', 'black', 'white', 'yellow', 'maroon', 'printed',
+    'embroidered', 'handloom', 'classic', 'premium', 'casual', 'formal',
+    'festive', 'summer', 'winter', 'kids', 'men', 'women', 'unisex',
+]
+
+
+def vocabulary(rng, size=5000):
+    'Made-up words, so that most of them are rare like real product terms'
+    words = set(WORDS)
+    while len(words) < size:
+        words.add(''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+class SearchView:
+    search_fields = ['name', 'description']
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the search index with the icontains SearchFilter on a catalog generated '
+        'in a test database, which is created for the run and destroyed afterwards'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # Never touches the configured database, as with the test runner.
+        old_config = setup_databases(
+            verbosity=options['verbosity'], interactive=False,
+            aliases={DEFAULT_DB_ALIAS}, serialized_aliases=set())
+        try:
+            search.get_backend().create_index()
+            category = models.Category.objects.create(name='search-benchmark')
+            self.generate(category, options['products'], rng)
+            self.compare(category, options['repeat'])
+        finally:
+            teardown_databases(old_config, verbosity=options['verbosity'])
+
+    def generate(self, category, count, rng):
+        start = time.perf_counter()
+        words = vocabulary(rng)
+        for offset in range(0, count, 5000):
+            products = models.Product.objects.bulk_create([
+                models.Product(
+                    name=' '.join(rng.sample(WORDS, 2) + rng.sample(words, 1)).title(),
+                    description=' '.join(rng.choices(words, k=40)),
+                    category=category,
+                )
+                for _ in range(min(5000, count - offset))
+            ])
+            if not products[0].pk:
+                products = list(models.Product.objects.filter(
+                    category=category).order_by('-pk')[:len(products)])
+            models.ProductVariant.objects.bulk_create([
+                models.ProductVariant(
+                    product=product, name=rng.choice(['S', 'M', 'L', 'XL']),
+                    mrp=100, price=rng.randint(50, 100), stock=10)
+                for product in products
+            ])
+            search.update_index([product.pk for product in products])
+        self.stdout.write(
+            f'Generated and indexed {count} products in {time.perf_counter() - start:.2f}s')
+
+    def run(self, backend, query, queryset):
+        request = Request(RequestFactory().get('/', {'search': query}))
+        start = time.perf_counter()
+        results = backend.filter_queryset(request, queryset, SearchView())
+        total = results.count()
+        list(results[:24])
+        return time.perf_counter() - start, total
+
+    def compare(self, category, repeat):
+        queryset = models.Product.objects.all()
+        queries = ['silk', 'red kurta', 'embroidered festive saree', 'handl', 'karito', 'nothingmatches']
+        self.stdout.write(
+            f"{'query':<28}{'icontains':>12}{'index':>12}{'matches':>18}")
+        for query in queries:
+            timings = {}
+            for name, backend in [('icontains', SearchFilter()), ('index', ProductSearchFilter())]:
+                runs = [self.run(backend, query, queryset) for _ in range(repeat)]
+                timings[name] = (min(run[0] for run in runs), runs[0][1])
+            self.stdout.write(
+                f"{query:<28}{timings['icontains'][0] * 1000:>10.1f}ms"
+                f"{timings['index'][0] * 1000:>10.1f}ms"
+                f"{timings['icontains'][1]:>9}/{timings['index'][1]:<8}"
+            )
+        self.stdout.write(f'Backend: {type(search.get_backend()).__name__}')
@@ -0,0 +1,18 @@
+from ecom import inventory
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Cancels the unpaid orders whose stock reservations have expired, releasing their stock'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            order_ids = inventory.expire_reservations(limit=options['chunk_size'])
+            if not order_ids:
+                break
+            total += len(order_ids)
+        self.stdout.write(self.style.SUCCESS(f'Cancelled {total} unpaid orders'))
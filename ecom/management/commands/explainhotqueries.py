@@ -0,0 +1,132 @@
+import json
+from ecom import models
+from authentication.models import OTP
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Exists, Max, OuterRef, Q
+from django.utils import timezone
+
+'''
+The queries run on every request of the cart, wishlist, login, order and
+catalog endpoints, and by the order admin and maintenance commands, with
+placeholder values. Add the lookups of new hot paths here, so that a
+missing index fails the build instead of production.
+'''
+
+
+def hot_queries():
+    now = timezone.now()
+    return {
+        'cart of a user': models.Cart.objects.filter(user_id=1),
+        'guest cart': models.Cart.objects.filter(guest_token='token'),
+        'cart lines': models.CartItem.objects.filter(
+            cart_id=1).select_related('product_variant__product'),
+        'cart line of a variant': models.CartItem.objects.filter(
+            cart_id=1, product_variant_id=1),
+        'whishlist of a user': models.Wishlist.objects.filter(user_id=1),
+        'whishlist flag': models.Wishlist.objects.filter(user_id=1, product_id=1),
+        'otp check': OTP.objects.filter(
+            phone_number='+919999999999', otp='1234', created_at__gte=now),
+        'product listing': models.Product.objects.order_by('-available', 'name', 'id')[:24],
+        'products of a category': models.Product.objects.filter(category_id=1),
+        'lowest variant price': models.ProductVariant.objects.filter(
+            product_id=1).order_by('price')[:1],
+        'cover image': models.ProductImage.objects.filter(
+            product_id=1).order_by('sort_order', 'id')[:1],
+        'order history': models.Order.objects.filter(
+            user_id=1).order_by('-created_at', 'id')[:20],
+        'archived order history': models.ArchivedOrder.objects.filter(
+            user_id=1).order_by('-created_at', 'id')[:20],
+        'orders by status': models.Order.objects.filter(
+            status='Pending').order_by('-created_at')[:100],
+        'latest order status': models.OrderStatus.objects.filter(
+            order_id__in=[1, 2]).values('order_id').annotate(latest=Max('status')),
+        'expired reservations': models.StockReservation.objects.filter(
+            state=models.StockReservation.HELD, expires_at__lte=now),
+        'guest carts to write': models.Cart.objects.filter(
+            pending_since__lte=now, user__isnull=True).order_by('pending_since')[:500],
+        'guest carts to purge': models.Cart.objects.filter(
+            Q(written_at__lt=now) | Q(written_at__isnull=True), guest_token__isnull=False,
+            pending_since__isnull=True, user__isnull=True).order_by('written_at')[:500],
+        'orders due for archival': models.Order.objects.filter(
+            ~Exists(models.ArchivedOrder.objects.filter(pk=OuterRef('pk'))),
+            status__in=['Delivered', 'Cancelled', 'Returned'], created_at__lt=now),
+    }
+
+
+def sqlite_full_scans(plan):
+    '''
+    The tables an SQLite query plan reads in full: "SCAN table" without an
+    index, where "SEARCH" and "SCAN table USING INDEX" use one.
+    '''
+    scans = []
+    for line in plan.splitlines():
+        detail = line.split(' ', 3)[-1] if line[:1].isdigit() else line
+        if detail.startswith('SCAN ') and ' USING ' not in detail:
+            table = detail.split()[1]
+            if table != 'CONSTANT':
+                scans.append(table)
+    return scans
+
+
+def mysql_full_scans(plan):
+    '''
+    The tables a MySQL JSON query plan reads in full (access type ALL).
+    '''
+    scans = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if node.get('access_type') == 'ALL':
+                scans.append(node.get('table_name'))
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(json.loads(plan))
+    return scans
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs EXPLAIN on the hot queries of the app and fails when one of them reads a '
+        'whole table. Run it on SQLite or MySQL, with tables that hold realistic data on '
+        'MySQL, whose planner scans tiny tables in full.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Only explain these queries')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            explain, full_scans = (lambda queryset: queryset.explain()), sqlite_full_scans
+        elif connection.vendor == 'mysql':
+            explain, full_scans = (
+                lambda queryset: queryset.explain(format='json')), mysql_full_scans
+        else:
+            raise CommandError(f'Query plans of {connection.vendor} are not supported')
+
+        queries = hot_queries()
+        unknown = set(options['names']) - set(queries)
+        if unknown:
+            raise CommandError(f"Unknown queries: {', '.join(sorted(unknown))}")
+        failed = []
+        for name, queryset in queries.items():
+            if options['names'] and name not in options['names']:
+                continue
+            plan = explain(queryset)
+            scans = full_scans(plan)
+            if scans:
+                failed.append(name)
+                self.stdout.write(self.style.ERROR(
+                    f"{name}: full scan of {', '.join(scans)}"))
+            else:
+                self.stdout.write(f'{name}: ok')
+            if scans or options['verbosity'] > 1:
+                self.stdout.write(f'    {str(queryset.query)}')
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+        if failed:
+            raise CommandError(f'{len(failed)} hot queries read whole tables')
+        self.stdout.write(self.style.SUCCESS('No hot query reads a whole table'))
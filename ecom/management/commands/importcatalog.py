@@ -0,0 +1,272 @@
+import csv
+import json
+import time
+import posixpath
+from itertools import islice
+from ecom import carts
+from ecom import models
+from ecom import search
+from ecom.cache import bump_catalog_version, bump_product_versions
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+'''
+Imports a catalog from a CSV file (with a header row) or a JSON Lines file,
+with one row per variant:
+
+    category, product, description, available, variant, mrp, price, stock,
+    variant_available, sort_order, images
+
+Categories are matched by name, products by category and name, variants by
+product and name, and images by their path in the storage; rows that match
+update the existing ones. images is a list of paths (separated by | in CSV)
+giving the images of the product in order, and replaces the images it had.
+
+The rows are read and written in chunks with bulk queries, so that the
+import runs in constant memory and without the catalog signals. What the
+signals would have done happens once: the search index and product
+versions are updated per chunk, and the carts are swept and the catalog
+version bumped at the end.
+'''
+
+PRODUCT_FIELDS = ['description', 'available']
+VARIANT_FIELDS = ['mrp', 'price', 'stock', 'available', 'sort_order']
+TRUE_VALUES = ('true', '1', 'yes', 'y')
+
+
+def read_rows(file, format):
+    if format == 'csv':
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def parse_bool(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def parse_images(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split('|')
+    return [path.strip() for path in value if path.strip()]
+
+
+def parse_row(row, number):
+    try:
+        return {
+            'category': row['category'].strip(),
+            'product': row['product'].strip(),
+            'description': row.get('description') or '',
+            'available': parse_bool(row.get('available')),
+            'variant': row['variant'].strip(),
+            'mrp': float(row['mrp']),
+            'price': float(row['price']),
+            'stock': int(row['stock']),
+            'variant_available': parse_bool(row.get('variant_available')),
+            'sort_order': int(row.get('sort_order') or 0),
+            'images': parse_images(row.get('images')),
+        }
+    except KeyError as error:
+        raise CommandError(f'Row {number}: {error.args[0]} is missing')
+    except (AttributeError, TypeError, ValueError) as error:
+        raise CommandError(f'Row {number}: {error}')
+
+
+def sync(model, existing, wanted, fields):
+    '''
+    Creates the wanted instances missing from existing and updates the
+    fields of those that differ, both keyed by natural key. Returns the
+    numbers of created and updated rows.
+    '''
+    created, updated = [], []
+    for key, values in wanted.items():
+        instance = existing.get(key)
+        if instance is None:
+            created.append(model(**values))
+        elif any(getattr(instance, field) != values[field] for field in fields):
+            for field in fields:
+                setattr(instance, field, values[field])
+            updated.append(instance)
+    model.objects.bulk_create(created)
+    if updated:
+        model.objects.bulk_update(updated, fields)
+    return len(created), len(updated)
+
+
+class Command(BaseCommand):
+    help = 'Imports categories, products, variants and images from a CSV or JSON Lines file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Defaults to jsonl for .jsonl and .ndjson files, csv otherwise')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or (
+            'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        chunk_size = options['chunk_size']
+        self.categories = {}
+        for category_id, name in models.Category.objects.order_by(
+                '-pk').values_list('pk', 'name'):
+            self.categories[name] = category_id
+        self.counts = dict.fromkeys(
+            ['products created', 'products updated', 'variants created',
+             'variants updated', 'images created'], 0)
+
+        start = time.perf_counter()
+        total = 0
+        try:
+            file = open(path, newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(error)
+        with file:
+            rows = read_rows(file, format)
+            while True:
+                try:
+                    chunk = [
+                        parse_row(row, total + number)
+                        for number, row in enumerate(islice(rows, chunk_size), 1)
+                    ]
+                except (csv.Error, json.JSONDecodeError) as error:
+                    raise CommandError(f'Row {total + 1} onwards: {error}')
+                if not chunk:
+                    break
+                product_ids = self.import_chunk(chunk)
+                search.update_index(product_ids)
+                bump_product_versions(product_ids)
+                total += len(chunk)
+                if options['verbosity'] > 1:
+                    self.stdout.write(
+                        f'{total} rows, {total / (time.perf_counter() - start):.0f} rows/s')
+
+        carts.sweep_unavailable()
+        bump_catalog_version()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {total} rows in {elapsed:.2f}s '
+            f'({total / elapsed if elapsed else 0:.0f} rows/s): '
+            + ', '.join(f'{count} {name}' for name, count in self.counts.items())
+        ))
+        if self.counts['images created']:
+            self.stdout.write('Run processimages to create the resized copies of the new images.')
+
+    @transaction.atomic
+    def import_chunk(self, rows):
+        '''
+        Imports a chunk of rows and returns the ids of their products.
+        '''
+        self.import_categories(rows)
+        products = self.import_products(rows)
+        self.import_variants(rows, products)
+        self.import_images(rows, products)
+        return list(products.values())
+
+    def import_categories(self, rows):
+        names = {row['category'] for row in rows} - set(self.categories)
+        if names:
+            models.Category.objects.bulk_create(
+                [models.Category(name=name) for name in names])
+            self.categories.update(models.Category.objects.filter(
+                name__in=names).values_list('name', 'pk'))
+
+    def import_products(self, rows):
+        '''
+        Returns the ids of the products of the rows, by (category id, name).
+        '''
+        wanted = {}
+        for row in rows:
+            key = (self.categories[row['category']], row['product'])
+            wanted[key] = {
+                'category_id': key[0], 'name': key[1],
+                'description': row['description'], 'available': row['available'],
+            }
+
+        def existing():
+            products = {}
+            for product in models.Product.objects.filter(
+                category_id__in={key[0] for key in wanted},
+                name__in={key[1] for key in wanted},
+            ).order_by('-pk'):
+                products[(product.category_id, product.name)] = product
+            return products
+
+        created, updated = sync(models.Product, existing(), wanted, PRODUCT_FIELDS)
+        self.counts['products created'] += created
+        self.counts['products updated'] += updated
+        return {
+            key: product.pk for key, product in existing().items() if key in wanted}
+
+    def import_variants(self, rows, products):
+        wanted = {}
+        for row in rows:
+            product_id = products[(self.categories[row['category']], row['product'])]
+            wanted[(product_id, row['variant'])] = {
+                'product_id': product_id, 'name': row['variant'],
+                'mrp': row['mrp'], 'price': row['price'], 'stock': row['stock'],
+                'available': row['variant_available'], 'sort_order': row['sort_order'],
+            }
+        existing = {}
+        for variant in models.ProductVariant.objects.filter(
+                product_id__in=products.values()).order_by('-pk'):
+            existing[(variant.product_id, variant.name)] = variant
+        created, updated = sync(models.ProductVariant, existing, wanted, VARIANT_FIELDS)
+        self.counts['variants created'] += created
+        self.counts['variants updated'] += updated
+
+    def import_images(self, rows, products):
+        paths = {}
+        for row in rows:
+            product_id = products[(self.categories[row['category']], row['product'])]
+            for path in row['images']:
+                paths.setdefault(product_id, {}).setdefault(path, None)
+        if not paths:
+            return
+        all_paths = {path for product_paths in paths.values() for path in product_paths}
+
+        def existing():
+            return dict(models.Image.objects.filter(
+                image__in=all_paths).order_by('-pk').values_list('image', 'pk'))
+
+        images = existing()
+        missing = all_paths - set(images)
+        if missing:
+            models.Image.objects.bulk_create([
+                models.Image(name=posixpath.splitext(posixpath.basename(path))[0][:100], image=path)
+                for path in missing
+            ])
+            self.counts['images created'] += len(missing)
+            images = existing()
+
+        # The images listed for a product replace the ones it had.
+        wanted = {
+            (product_id, images[path]): {
+                'product_id': product_id, 'image_id': images[path], 'sort_order': index}
+            for product_id, product_paths in paths.items()
+            for index, path in enumerate(product_paths)
+        }
+        current = {}
+        stale = []
+        for product_image in models.ProductImage.objects.filter(product_id__in=paths):
+            key = (product_image.product_id, product_image.image_id)
+            if key in wanted and key not in current:
+                current[key] = product_image
+            else:
+                stale.append(product_image.pk)
+        if stale:
+            # A raw delete, so that the catalog signals do not run once per row.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {models.ProductImage._meta.db_table} WHERE id IN '
+                    f"({', '.join(['%s'] * len(stale))})", stale)
+        sync(models.ProductImage, current, wanted, ['sort_order'])
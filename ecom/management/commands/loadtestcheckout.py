@@ -0,0 +1,96 @@
+import time
+import threading
+from ecom import models
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.test import APIClient
+
+
+class Command(BaseCommand):
+    help = (
+        'Places orders for the same variant from many threads at once and checks that '
+        'no more is sold than was in stock. Run it against the production database '
+        'engine; SQLite serialises every write.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stock', type=int, default=50)
+        parser.add_argument('--buyers', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--quantity', type=int, default=1)
+
+    def handle(self, *args, **options):
+        stock, buyers = options['stock'], options['buyers']
+        User = get_user_model()
+        phone_numbers = [f'+9170{index:08d}' for index in range(buyers)]
+        if User.objects.filter(**{f'{User.USERNAME_FIELD}__in': phone_numbers}).exists():
+            raise CommandError('The load test users already exist, remove them first')
+
+        category = models.Category.objects.create(name=f'checkout-load-test-{time.time_ns()}')
+        product = models.Product.objects.create(
+            name='Load test product', description='Load test', category=category)
+        variant = models.ProductVariant.objects.create(
+            product=product, name='Load test', mrp=100, price=100, stock=stock)
+        users = []
+        try:
+            for phone_number in phone_numbers:
+                user = User.objects.create_user(**{User.USERNAME_FIELD: phone_number}, password=None)
+                users.append(user)
+                address = models.Address.objects.create(
+                    user=user, name='Load test', address='Load test', city='Load test',
+                    state='Load test', pincode='000000', phone_number=phone_number)
+                cart = models.Cart.objects.get(user=user)
+                cart.address = address
+                cart.save(update_fields=['address'])
+                models.CartItem.objects.create(
+                    cart=cart, product_variant=variant, quantity=options['quantity'])
+            self.run(users, options['threads'])
+            self.report(variant, stock, buyers, options['quantity'])
+        finally:
+            models.Order.objects.filter(user__in=users).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+            category.delete()
+
+    def run(self, users, threads):
+        queue = list(users)
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads)
+        self.results = {}
+
+        def buyer():
+            client = APIClient()
+            try:
+                barrier.wait()
+                while True:
+                    with lock:
+                        if not queue:
+                            return
+                        user = queue.pop()
+                    client.force_authenticate(user)
+                    status = client.post('/api/ecom/orders/').status_code
+                    with lock:
+                        self.results[status] = self.results.get(status, 0) + 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=buyer) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.elapsed = time.perf_counter() - start
+
+    def report(self, variant, stock, buyers, quantity):
+        variant.refresh_from_db()
+        placed = models.Order.objects.filter(items__product_variant=variant).count()
+        expected = min(stock // quantity, buyers)
+        self.stdout.write(
+            f'{buyers} checkouts in {self.elapsed:.2f}s '
+            f'({buyers / self.elapsed:.0f}/s, {placed / self.elapsed:.0f} orders/s), '
+            f'responses {dict(sorted(self.results.items()))}')
+        self.stdout.write(f'Stock {stock} -> {variant.stock}, {placed} orders placed')
+        if placed != expected or variant.stock != stock - placed * quantity or variant.stock < 0:
+            raise CommandError(f'Expected {expected} orders and no oversold stock')
+        self.stdout.write(self.style.SUCCESS('No stock was oversold'))
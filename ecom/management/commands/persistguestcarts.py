@@ -0,0 +1,24 @@
+import datetime
+from ecom import carts
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the guest carts whose changes have waited ECOM_GUEST_CART_WRITE_DELAY seconds '
+        'to the database. Run it every minute when ECOM_GUEST_CART_CACHE is set.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(seconds=carts.get_write_delay())
+        total = 0
+        while True:
+            written = carts.persist_pending(before, limit=options['chunk_size'])
+            if not written:
+                break
+            total += written
+        self.stdout.write(self.style.SUCCESS(f'Wrote {total} guest carts'))
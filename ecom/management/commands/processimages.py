@@ -0,0 +1,60 @@
+import time
+from ecom import images
+from ecom import models
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Creates the resized copies of the images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true', help='Process images whose content has not changed')
+        parser.add_argument(
+            '--workers', type=int, default=2, help='The number of worker processes, 0 for none')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        processed = skipped = failed = 0
+        pending = []
+        workers = options['workers']
+        executor = images.create_executor(workers) if workers else None
+
+        def store(item):
+            nonlocal processed, failed
+            image, digest, result = item
+            try:
+                images.store_derivatives(
+                    image.pk, digest, result.result() if executor else result)
+                processed += 1
+            except Exception as error:
+                failed += 1
+                self.stderr.write(f'Image {image.pk}: {error}')
+
+        for image in models.Image.objects.order_by('pk').iterator(chunk_size=100):
+            try:
+                data = images.read_image(image)
+            except OSError as error:
+                failed += 1
+                self.stderr.write(f'Image {image.pk}: {error}')
+                continue
+            digest = images.content_hash(data)
+            if not options['force'] and not images.needs_processing(image, digest):
+                skipped += 1
+                continue
+            if executor:
+                # Keep a bounded number of originals in flight.
+                pending.append((image, digest, executor.submit(images.render_derivatives, data)))
+                if len(pending) >= workers * 4:
+                    store(pending.pop(0))
+            else:
+                store((image, digest, images.render_derivatives(data)))
+        for item in pending:
+            store(item)
+        if executor:
+            executor.shutdown()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {processed} images, skipped {skipped} unchanged, '
+            f'{failed} failed in {time.perf_counter() - start:.2f}s'
+        ))
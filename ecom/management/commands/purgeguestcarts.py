@@ -0,0 +1,18 @@
+from ecom import carts
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Deletes the guest carts that were not written for as long as their tokens are valid'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            deleted = carts.purge_guest_carts(limit=options['chunk_size'])
+            if not deleted:
+                break
+            total += deleted
+        self.stdout.write(self.style.SUCCESS(f'Deleted {total} guest carts'))
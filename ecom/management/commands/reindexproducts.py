@@ -0,0 +1,52 @@
+import time
+from ecom import models
+from ecom import search
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Creates the product search index if needed and rebuilds it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument(
+            '--create-index', action='store_true',
+            help='Only build the documents and create the index (the FTS5 table or '
+                 'FULLTEXT indexes) from them if it does not exist')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        backend = search.get_backend()
+        start = time.perf_counter()
+        if options['create_index']:
+            if backend.index_exists():
+                self.stdout.write('The search index exists')
+                return
+            # The index is created last, from the documents, so that search
+            # falls back to icontains lookups until it can find every product.
+            total = self.index_products(chunk_size)
+            backend.create_index()
+        else:
+            backend.create_index()
+            backend.clear()
+            models.ProductSearchDocument.objects.all().delete()
+            total = self.index_products(chunk_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {total} products with {type(backend).__name__} '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
+
+    def index_products(self, chunk_size):
+        total = 0
+        last_id = 0
+        while True:
+            product_ids = list(models.Product.objects.filter(
+                pk__gt=last_id
+            ).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not product_ids:
+                break
+            search.update_index(product_ids)
+            total += len(product_ids)
+            last_id = product_ids[-1]
+        return total
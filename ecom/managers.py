@@ -0,0 +1,112 @@
+from django.db import models
+from django.db.models import BooleanField, Count, Exists, Max, Min, OuterRef, Prefetch, Subquery, Value
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_prices(self):
+        """
+        Annotates the price range and variant count used by the product
+        serializers, so they do not have to aggregate once per product.
+        """
+        queryset = self.annotate(
+            min_price=Min('variants__price'),
+            max_price=Max('variants__price'),
+            variant_count=Count('variants', distinct=True),
+        )
+        # Meta.ordering is not applied to aggregated queries.
+        if not queryset.query.order_by:
+            queryset = queryset.order_by(*self.model._meta.ordering)
+        return queryset
+
+    def with_lowest_price(self):
+        """
+        Annotates the lowest variant price with a subquery rather than a join,
+        so that it can be filtered and grouped on.
+        """
+        from .models import ProductVariant
+
+        return self.annotate(lowest_price=Subquery(
+            ProductVariant.objects.filter(
+                product=OuterRef('pk')
+            ).order_by('price').values('price')[:1]
+        ))
+
+    def with_whishlist(self, user=None):
+        """
+        Annotates whether the product is in the given user's whishlist.
+        """
+        from .models import Wishlist
+
+        if user is None or not user.is_authenticated:
+            return self.annotate(
+                is_whishlisted=Value(False, output_field=BooleanField()))
+        return self.annotate(
+            is_whishlisted=Exists(
+                Wishlist.objects.filter(user=user, product=OuterRef('pk'))))
+
+    def with_media(self, images=True, variants=True):
+        """
+        Prefetches the images (with their files) and variants of the products.
+        """
+        from .models import ProductImage
+
+        lookups = []
+        if images:
+            lookups.append(Prefetch(
+                'productimage_set',
+                queryset=ProductImage.objects.select_related('image')))
+        if variants:
+            lookups.append('variants')
+        return self.prefetch_related(*lookups)
+
+    def for_catalog(self, user=None, fields=None):
+        """
+        Everything the catalog serializers read, in a fixed number of queries.
+        With fields, the names of the ProductSerializer fields that will be
+        rendered, only what those fields read is annotated and prefetched.
+        """
+        def wanted(*names):
+            return fields is None or any(name in fields for name in names)
+
+        queryset = self
+        if wanted('start_price', 'end_price'):
+            queryset = queryset.with_prices()
+        if wanted('whishlist'):
+            queryset = queryset.with_whishlist(user)
+        return queryset.with_media(images=wanted('images'), variants=wanted('variants'))
+
+
+def cart_lines(images=False):
+    """
+    A Prefetch of the lines of carts, with their variants and products, and
+    with images the first image of every product as product.cover_images.
+    """
+    from .models import CartItem, ProductImage
+
+    lines = CartItem.objects.select_related('product_variant__product')
+    if images:
+        lines = lines.prefetch_related(
+            Prefetch(
+                'product_variant__product__productimage_set',
+                queryset=ProductImage.objects.select_related(
+                    'image').order_by('sort_order', 'id')[:1],
+                to_attr='cover_images'),
+        )
+    return Prefetch('cartitem_set', queryset=lines)
+
+
+class CartQuerySet(models.QuerySet):
+    def for_pricing(self):
+        """
+        Loads the coupon, address and lines (with their variants and
+        products) that pricing a cart reads.
+        """
+        return self.select_related('coupon', 'address').prefetch_related(cart_lines())
+
+    def for_display(self):
+        """
+        for_pricing(), plus the first image of every product in the cart as
+        product.cover_images, for the cart serializers.
+        """
+        return self.select_related('coupon', 'address').prefetch_related(
+            cart_lines(images=True))
@@ -1,6 +1,7 @@
 from django.db import models
 from django.db.models import F, Sum
 from authentication.models import User
+from .managers import CartQuerySet, ProductQuerySet
 from phonenumber_field.modelfields import PhoneNumberField
 
 # Create your models here.
@@ -10,6 +11,8 @@ class Image(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=100)
     image = models.ImageField(upload_to='images/')
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return self.name
@@ -39,8 +42,14 @@ class Product(models.Model):
         Image, through='ProductImage', related_name='products')
     available = models.BooleanField(default=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         ordering = ['-available', 'name']
+        indexes = [
+            models.Index(
+                fields=['-available', 'name', 'id'], name='ecom_product_listing_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -59,6 +68,9 @@ class ProductVariant(models.Model):
 
     class Meta:
         ordering = ['-available', 'sort_order']
+        indexes = [
+            models.Index(fields=['product', 'price'], name='ecom_variant_price_idx'),
+        ]
 
     def __str__(self):
         return f"{self.product.name} - {self.name}"
@@ -74,6 +86,18 @@ class ProductImage(models.Model):
         ordering = ['sort_order']
 
 
+class ProductSearchDocument(models.Model):
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    name = models.CharField(max_length=100)
+    variant_names = models.TextField(blank=True)
+    category_name = models.CharField(max_length=100, blank=True)
+    description = models.TextField(blank=True)
+
+    def __str__(self):
+        return self.name
+
+
 class Coupon(models.Model):
     code = models.CharField(max_length=100, unique=True)
     discount = models.FloatField()
@@ -102,7 +126,9 @@ class Coupon(models.Model):
 class Cart(models.Model):
     id = models.AutoField(primary_key=True)
     user = models.OneToOneField(
-        User, on_delete=models.CASCADE, related_name='cart')
+        User, on_delete=models.CASCADE, related_name='cart', blank=True, null=True)
+    guest_token = models.CharField(
+        max_length=64, unique=True, blank=True, null=True, editable=False)
     address = models.OneToOneField(
         'Address', on_delete=models.SET_NULL, blank=True, null=True, related_name='cart'
     )
@@ -112,6 +138,24 @@ class Cart(models.Model):
         Coupon, on_delete=models.SET_NULL, blank=True, null=True)
     payment_mode = models.CharField(
         max_length=20, blank=True, null=True)
+    # Bumped on every change of the cart, see ecom.carts.touch_cart.
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+    # The versions in which lines were removed, by variant id, and the
+    # oldest version changes can be listed since.
+    removed_lines = models.JSONField(default=dict, blank=True, editable=False)
+    delta_base = models.PositiveBigIntegerField(default=0, editable=False)
+    # Guest carts only: since when changes in the cache wait to be written,
+    # and when the cart was last written; see ecom.carts.
+    pending_since = models.DateTimeField(blank=True, null=True, editable=False)
+    written_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['pending_since'], name='ecom_cart_pending_idx'),
+            models.Index(fields=['written_at'], name='ecom_cart_written_idx'),
+        ]
 
     @property
     def sub_total(self):
@@ -120,7 +164,14 @@ class Cart(models.Model):
         )['total'] or 0
         return round(total, 2)
 
+    @property
+    def pricing(self):
+        from .utils import get_pricing
+        return get_pricing(self)
+
     def __str__(self):
+        if self.user_id is None:
+            return f"{self.id} guest cart"
         return f"{self.id} {self.user.username}'s cart"
 
 
@@ -130,6 +181,14 @@ class CartItem(models.Model):
     product_variant = models.ForeignKey(
         ProductVariant, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    # The cart version in which the line last changed.
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['cart', 'product_variant'], name='ecom_cartitem_unique_variant'),
+        ]
 
 
 class Wishlist(models.Model):
@@ -140,6 +199,12 @@ class Wishlist(models.Model):
         Product, on_delete=models.CASCADE, related_name='whishlists')
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'product'], name='ecom_wishlist_unique_product'),
+        ]
+
     def __str__(self):
         return f"{self.user.username}'s whishlist"
 
@@ -168,12 +233,23 @@ class Order(models.Model):
     landmark = models.CharField(max_length=100, blank=True, null=True)
     phone_number = PhoneNumberField(blank=False, null=False)
     alternate_phone_number = PhoneNumberField(blank=True, null=True)
+    sub_total = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    coupon_code = models.CharField(max_length=100, blank=True, null=True)
+    shipping = models.FloatField(default=0)
+    tax = models.FloatField(default=0)
     total = models.FloatField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=100, blank=True, null=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['user', '-created_at', 'id'], name='ecom_order_history_idx'),
+            # The admin status filter, and the orders due for archival.
+            models.Index(fields=['status', '-created_at'], name='ecom_order_status_idx'),
+        ]
 
     def __str__(self):
         return f"Order #{self.id}"
@@ -210,11 +286,72 @@ class OrderStatus(models.Model):
     class Meta:
         ordering = ['status']
         verbose_name_plural = 'order statuses'
+        indexes = [
+            models.Index(fields=['order', 'status'], name='ecom_orderstatus_order_idx'),
+        ]
 
     def __str__(self):
         return STATUS_CHOICES[self.status]
 
 
+class ArchivedOrder(models.Model):
+    '''
+    A finished order moved out of the order tables, with the order, its
+    items and statuses as rendered by the API in data; see ecom.archive.
+    '''
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='archived_orders')
+    created_at = models.DateTimeField()
+    status = models.CharField(max_length=100, blank=True, null=True)
+    total = models.FloatField(default=0)
+    item_count = models.PositiveIntegerField(default=0)
+    data = models.JSONField(default=dict)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['user', '-created_at', 'id'], name='ecom_archive_history_idx'),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.id}"
+
+
+class StockReservation(models.Model):
+    '''
+    Stock taken from a variant for an order. Held reservations of unpaid
+    orders expire; see ecom.inventory.
+    '''
+    HELD = 'held'
+    COMMITTED = 'committed'
+    RELEASED = 'released'
+
+    id = models.AutoField(primary_key=True)
+    order = models.ForeignKey(
+        Order, on_delete=models.CASCADE, related_name='reservations')
+    product_variant = models.ForeignKey(
+        ProductVariant, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    state = models.CharField(max_length=10, default=HELD, choices=(
+        (HELD, 'Held'),
+        (COMMITTED, 'Committed'),
+        (RELEASED, 'Released'),
+    ))
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'expires_at'], name='ecom_reservation_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_variant_id} for order #{self.order_id}"
+
+
 class Address(models.Model):
     id = models.AutoField(primary_key=True)
     user = models.ForeignKey(
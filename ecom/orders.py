@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models import Max
+from . import inventory
+from . import models
+
+'''
+Moving orders through STATUS_CHOICES in bulk, for fulfilment.
+'''
+
+CHUNK_SIZE = 1000
+# Cancelled and returned orders have had their stock put back, and move no
+# further, even though later statuses come after Cancelled.
+TERMINAL_STATUSES = inventory.RELEASING_STATUSES
+
+
+def change_status(order_ids, status):
+    '''
+    Moves orders to status, an index into STATUS_CHOICES, in one transaction
+    with a fixed number of queries per thousand orders. Orders only move
+    forward, so orders already at or past status, or cancelled or returned,
+    are left as they are.
+    Returns the ids of the orders that moved and {id: reason} for the rest.
+    '''
+    order_ids = list(dict.fromkeys(order_ids))
+    name = models.STATUS_CHOICES[status]
+    changed, rejected = [], {}
+    with transaction.atomic():
+        for start in range(0, len(order_ids), CHUNK_SIZE):
+            chunk = order_ids[start:start + CHUNK_SIZE]
+            existing = set(models.Order.objects.select_for_update().filter(
+                pk__in=chunk).order_by('pk').values_list('pk', flat=True))
+            current = dict(models.OrderStatus.objects.filter(
+                order_id__in=existing
+            ).order_by().values('order_id').annotate(
+                latest=Max('status')).values_list('order_id', 'latest'))
+            moving = []
+            for order_id in chunk:
+                if order_id not in existing:
+                    rejected[order_id] = 'Order not found'
+                elif current.get(order_id, -1) >= status or current.get(
+                        order_id) in TERMINAL_STATUSES:
+                    rejected[order_id] = f'Already {models.STATUS_CHOICES[current[order_id]]}'
+                else:
+                    moving.append(order_id)
+            models.OrderStatus.objects.bulk_create([
+                models.OrderStatus(order_id=order_id, status=status) for order_id in moving])
+            models.Order.objects.filter(pk__in=moving).update(status=name)
+            inventory.status_changed(moving, status)
+            changed += moving
+    return changed, rejected
@@ -0,0 +1,453 @@
+import re
+import bisect
+import math
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+from . import models
+from .utils import on_commit_batch
+
+'''
+Product search.
+
+Every product has a ProductSearchDocument row holding the text that is
+searched: the product name, its variant names, its category name and its
+description. The rows are kept up to date by the signal receivers, and the
+search backend indexes them:
+
+- SqliteSearchBackend keeps an FTS5 table next to the documents (DEBUG).
+- MySQLSearchBackend puts FULLTEXT indexes on the documents table.
+- PythonSearchBackend keeps an in-memory inverted index of the documents and
+  is used when the database has neither.
+
+The backend is chosen from the database vendor, unless ECOM_SEARCH_BACKEND
+holds the dotted path of a backend class.
+
+The FTS5 table and the FULLTEXT indexes are created by reindexproducts
+(reindexproducts --create-index only builds the documents and creates them
+when they do not exist), never by requests, as adding a FULLTEXT index
+rebuilds the table on MySQL. They index the documents that exist when they
+are created, and until they exist search_products() returns None and the
+API falls back to icontains lookups.
+'''
+
+DOCUMENT_FIELDS = ['name', 'variant_names', 'category_name', 'description']
+FIELD_WEIGHTS = {
+    'name': 10.0,
+    'variant_names': 4.0,
+    'category_name': 2.0,
+    'description': 1.0,
+}
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+class BaseSearchBackend:
+    def create_index(self):
+        pass
+
+    def index_exists(self):
+        return True
+
+    def index(self, documents):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def search(self, query, limit=None):
+        'Return the ids of the matching products, best match first, at most limit of them'
+        raise NotImplementedError
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    table = 'ecom_product_fts'
+
+    def __init__(self):
+        self.ready = False
+
+    def table_exists(self, cursor):
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table])
+        return cursor.fetchone() is not None
+
+    def create_index(self):
+        # Fills the table from the documents in the same transaction, so
+        # that searches never see it empty.
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not self.table_exists(cursor):
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE {self.table} USING fts5("
+                    f"{', '.join(DOCUMENT_FIELDS)}, tokenize='unicode61 remove_diacritics 2')"
+                )
+                meta = models.ProductSearchDocument._meta
+                cursor.execute(
+                    f"INSERT INTO {self.table} (rowid, {', '.join(DOCUMENT_FIELDS)}) "
+                    f"SELECT {meta.pk.column}, {', '.join(DOCUMENT_FIELDS)} FROM {meta.db_table}"
+                )
+        self.ready = True
+
+    def index_exists(self):
+        if not self.ready:
+            with connection.cursor() as cursor:
+                self.ready = self.table_exists(cursor)
+        return self.ready
+
+    def index(self, documents):
+        # Without the table there is nothing to update, reindexproducts
+        # fills it from the documents when it creates it.
+        if not self.index_exists():
+            return
+        documents = list(documents)
+        self.remove([document.pk for document in documents])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, {', '.join(DOCUMENT_FIELDS)}) "
+                f"VALUES (%s, {', '.join(['%s'] * len(DOCUMENT_FIELDS))})",
+                [
+                    [document.pk] + [getattr(document, field) for field in DOCUMENT_FIELDS]
+                    for document in documents
+                ]
+            )
+
+    def remove(self, product_ids):
+        if not self.index_exists():
+            return
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {self.table} WHERE rowid IN ({', '.join(['%s'] * len(product_ids))})",
+                product_ids
+            )
+
+    def clear(self):
+        if not self.index_exists():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+
+    def search(self, query, limit=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        weights = ', '.join(str(FIELD_WEIGHTS[field]) for field in DOCUMENT_FIELDS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s "
+                f"ORDER BY bm25({self.table}, {weights}) LIMIT %s",
+                [match, -1 if limit is None else limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class MySQLSearchBackend(BaseSearchBackend):
+    '''
+    InnoDB maintains FULLTEXT indexes itself, so indexing only has to keep the
+    documents table up to date.
+    '''
+    index_name = 'ecom_search_fulltext'
+    name_index_name = 'ecom_search_fulltext_name'
+
+    def __init__(self):
+        self.ready = False
+        self.table = models.ProductSearchDocument._meta.db_table
+
+    def existing_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT index_name FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = %s",
+                [self.table]
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def index_exists(self):
+        if not self.ready:
+            self.ready = {self.index_name, self.name_index_name} <= self.existing_indexes()
+        return self.ready
+
+    def create_index(self):
+        existing = self.existing_indexes()
+        with connection.cursor() as cursor:
+            if self.index_name not in existing:
+                cursor.execute(
+                    f"ALTER TABLE {self.table} ADD FULLTEXT INDEX {self.index_name} "
+                    f"({', '.join(DOCUMENT_FIELDS)})"
+                )
+            if self.name_index_name not in existing:
+                cursor.execute(
+                    f"ALTER TABLE {self.table} ADD FULLTEXT INDEX {self.name_index_name} (name)"
+                )
+        self.ready = True
+
+    def search(self, query, limit=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        match = ' '.join(f'+{token}*' for token in tokens)
+        columns = ', '.join(DOCUMENT_FIELDS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {self.table} "
+                f"WHERE MATCH ({columns}) AGAINST (%s IN BOOLEAN MODE) "
+                f"ORDER BY MATCH (name) AGAINST (%s IN BOOLEAN MODE) * {FIELD_WEIGHTS['name']} "
+                f"+ MATCH ({columns}) AGAINST (%s IN BOOLEAN MODE) DESC"
+                f"{'' if limit is None else ' LIMIT %s'}",
+                [match, match, match] + ([] if limit is None else [limit])
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PythonSearchBackend(BaseSearchBackend):
+    '''
+    An inverted index of the search documents, held by each process.
+
+    Changes made by this process are applied to the index directly. Every
+    change bumps a version in the cache and records the changed products
+    under that version, and other processes reread only the documents of
+    those products when they see a newer version. The index is only loaded
+    in full by the first search of a process, or when the changes since its
+    version are too many or have been evicted from the cache.
+    '''
+    version_key = 'ecom:search:version'
+    changes_timeout = 60 * 60
+    changes_limit = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.reset()
+
+    def reset(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.terms = []
+        self.terms_dirty = False
+
+    def changes_key(self, version):
+        return f'{self.version_key}:{version}'
+
+    def bump_version(self, product_ids=None):
+        '''
+        Records a change of product_ids, None meaning that the whole index
+        changed.
+        '''
+        cache.add(self.version_key, 1, None)
+        version = cache.incr(self.version_key)
+        if product_ids is not None:
+            cache.set(self.changes_key(version), set(product_ids), self.changes_timeout)
+        # When other processes changed the index in the meantime their
+        # changes are picked up, with ours, by the next load().
+        if self.version is not None and version == self.version + 1:
+            self.version = version
+
+    def changed_between(self, start, end):
+        '''
+        The products changed after version start up to version end, or None
+        when they are unknown.
+        '''
+        # A version lower than ours means the cache lost the version.
+        if start is None or not start < end <= start + self.changes_limit:
+            return None
+        keys = [self.changes_key(version) for version in range(start + 1, end + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys):
+            return None
+        return set().union(*changes.values())
+
+    def load(self):
+        cache.add(self.version_key, 1, None)
+        version = cache.get(self.version_key)
+        if self.version == version:
+            return
+        product_ids = self.changed_between(self.version, version)
+        if product_ids is None:
+            self.reset()
+            for document in models.ProductSearchDocument.objects.iterator(chunk_size=2000):
+                self.add(document)
+        else:
+            self.refresh(product_ids)
+        self.version = version
+
+    def refresh(self, product_ids):
+        'Rereads the documents of product_ids'
+        product_ids = list(product_ids)
+        for product_id in product_ids:
+            self.discard(product_id)
+        for offset in range(0, len(product_ids), 1000):
+            for document in models.ProductSearchDocument.objects.filter(
+                    pk__in=product_ids[offset:offset + 1000]):
+                self.add(document)
+
+    def add(self, document):
+        weights = defaultdict(float)
+        for field in DOCUMENT_FIELDS:
+            for token in tokenize(getattr(document, field)):
+                weights[token] += FIELD_WEIGHTS[field]
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.terms_dirty = True
+            self.postings[token][document.pk] = weight
+        self.documents[document.pk] = list(weights)
+
+    def discard(self, product_id):
+        for token in self.documents.pop(product_id, []):
+            postings = self.postings.get(token)
+            if postings is not None:
+                postings.pop(product_id, None)
+                if not postings:
+                    del self.postings[token]
+                    self.terms_dirty = True
+
+    def index(self, documents):
+        with self.lock:
+            self.load()
+            for document in documents:
+                self.discard(document.pk)
+                self.add(document)
+            self.bump_version([document.pk for document in documents])
+
+    def remove(self, product_ids):
+        with self.lock:
+            self.load()
+            product_ids = list(product_ids)
+            for product_id in product_ids:
+                self.discard(product_id)
+            self.bump_version(product_ids)
+
+    def clear(self):
+        with self.lock:
+            self.reset()
+            self.bump_version()
+
+    def expand(self, token):
+        'Return the indexed terms starting with token'
+        start = bisect.bisect_left(self.terms, token)
+        end = bisect.bisect_left(self.terms, token + '\uffff')
+        return self.terms[start:end]
+
+    def search(self, query, limit=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self.lock:
+            self.load()
+            if self.terms_dirty:
+                self.terms = sorted(self.postings)
+                self.terms_dirty = False
+            total = len(self.documents) or 1
+            scores = None
+            for token in tokens:
+                token_scores = defaultdict(float)
+                for term in self.expand(token):
+                    postings = self.postings[term]
+                    idf = math.log(1 + total / len(postings))
+                    for product_id, weight in postings.items():
+                        token_scores[product_id] += weight * idf
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {
+                        product_id: score + token_scores[product_id]
+                        for product_id, score in scores.items()
+                        if product_id in token_scores
+                    }
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, _ in ranked[:limit]]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def create_backend():
+    path = getattr(settings, 'ECOM_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    if connection.vendor == 'mysql':
+        return MySQLSearchBackend()
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if cursor.fetchone()[0]:
+                return SqliteSearchBackend()
+    return PythonSearchBackend()
+
+
+def build_document(product: models.Product):
+    return models.ProductSearchDocument(
+        product=product,
+        name=product.name,
+        variant_names=' '.join(variant.name for variant in product.variants.all()),
+        category_name=product.category.name,
+        description=product.description,
+    )
+
+
+def update_index(product_ids):
+    '''
+    Rebuilds the search documents of the given products and reindexes them.
+    Products that no longer exist are removed from the index.
+    '''
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    products = models.Product.objects.filter(
+        pk__in=product_ids
+    ).select_related('category').prefetch_related('variants')
+    documents = [build_document(product) for product in products]
+    with transaction.atomic():
+        models.ProductSearchDocument.objects.filter(pk__in=product_ids).delete()
+        models.ProductSearchDocument.objects.bulk_create(documents)
+    backend = get_backend()
+    backend.index(documents)
+    missing = product_ids - {document.pk for document in documents}
+    if missing:
+        backend.remove(missing)
+
+
+def remove_from_index(product_ids):
+    product_ids = set(product_ids)
+    if product_ids:
+        get_backend().remove(product_ids)
+
+
+def schedule_update(product_ids):
+    on_commit_batch(update_index, product_ids)
+
+
+def schedule_remove(product_ids):
+    on_commit_batch(remove_from_index, product_ids)
+
+
+def search_products(query, limit=None):
+    '''
+    The ids of the products matching query, best match first, or None when
+    the search index has not been created yet.
+    '''
+    backend = get_backend()
+    if not backend.index_exists():
+        return None
+    return backend.search(query, limit=limit)
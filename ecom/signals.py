@@ -1,18 +1,25 @@
 
+from django.db.models import Max
 from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from . import models
+from . import carts
+from . import images
+from . import inventory
+from . import search
+from .cache import invalidate_catalog, invalidate_products, invalidate_whishlist
 
 '''
 The following function is used to update the denormalised order status field in the Order model.
+Status changes in bulk skip it and update the field themselves, see orders.change_status.
 '''
 
 
 def order_status_change(instance: models.OrderStatus):
-    order = instance.order
-    status = order.get_status_choices()[0][1]
-    order.status = status
-    order.save()
+    latest = models.OrderStatus.objects.filter(
+        order_id=instance.order_id).aggregate(latest=Max('status'))['latest']
+    models.Order.objects.filter(pk=instance.order_id).update(
+        status=models.STATUS_CHOICES[latest] if latest is not None else None)
 
 
 @receiver(post_save, sender=models.OrderStatus)
@@ -21,43 +28,126 @@ def order_status_post_save(sender, instance: models.OrderStatus, **kwargs):
 
 
 @receiver(post_delete, sender=models.OrderStatus)
-def order_status_post_delete(sender, instance: models.OrderStatus, **kwargs):
-    order_status_change(instance)
+def order_status_post_delete(sender, instance: models.OrderStatus, origin=None, **kwargs):
+    # Not when the statuses go along with their order (or its user).
+    if isinstance(origin, models.OrderStatus) or getattr(origin, 'model', None) is models.OrderStatus:
+        order_status_change(instance)
 
 
 '''
-The following function is used to remove the cart items if the product or product variant is not available.
+The following functions are used to commit or release the stock reserved for an order when its status changes,
+and to release the stock still held by an order that is deleted.
 '''
 
 
-def cart_product_available_check(instance: models.Product):
-    variants = models.ProductVariant.objects.filter(product=instance)
-    if not instance.available:
-        variants.update(available=False)
-        models.CartItem.objects.filter(product_variant__in=variants).delete()
-    else:
-        unavailable_variants = variants.filter(available=False)
-        models.CartItem.objects.filter(
-            product_variant__in=unavailable_variants).delete()
+@receiver(post_save, sender=models.OrderStatus)
+def order_stock_post_save(sender, instance: models.OrderStatus, created, **kwargs):
+    if created:
+        inventory.status_changed([instance.order_id], instance.status)
+
+
+@receiver(pre_delete, sender=models.Order)
+def order_stock_pre_delete(sender, instance: models.Order, **kwargs):
+    inventory.release([instance.pk], states=[models.StockReservation.HELD])
+
+
+'''
+The following functions are used to remove the cart items if the product or product variant is not available.
+The cleanup runs once per transaction for all the products saved in it, see carts.sweep_unavailable.
+Deleting a product or variant deletes its cart items along with it.
+'''
 
 
 @receiver(post_save, sender=models.Product)
 def cart_product_available_check_post_save(sender, instance: models.Product, **kwargs):
-    cart_product_available_check(instance)
+    carts.schedule_sweep([instance.pk])
+    search.schedule_update([instance.pk])
+    invalidate_products([instance.pk])
+    invalidate_catalog()
 
 
 @receiver(pre_delete, sender=models.Product)
 def cart_product_available_check_post_delete(sender, instance: models.Product, **kwargs):
-    instance.available = False
-    cart_product_available_check(instance)
+    search.schedule_remove([instance.pk])
+    invalidate_products([instance.pk])
+    invalidate_catalog()
 
 
 @receiver(post_save, sender=models.ProductVariant)
 def cart_product_variant_available_check_post_save(sender, instance: models.ProductVariant, **kwargs):
-    cart_product_available_check(instance.product)
+    carts.schedule_sweep([instance.product_id])
+    search.schedule_update([instance.product_id])
+    invalidate_products([instance.product_id])
+    invalidate_catalog()
 
 
 @receiver(pre_delete, sender=models.ProductVariant)
 def cart_product_variant_available_check_post_delete(sender, instance: models.ProductVariant, **kwargs):
-    instance.product.available = False
-    cart_product_available_check(instance.product)
+    search.schedule_update([instance.product_id])
+    invalidate_products([instance.product_id])
+    invalidate_catalog()
+
+
+'''
+The following function is used to reindex the products of a category when its name changes.
+It is connected before catalog_changed, so the index is updated before the catalog version changes.
+'''
+
+
+@receiver(post_save, sender=models.Category)
+def category_search_update(sender, instance: models.Category, created, **kwargs):
+    if not created:
+        search.schedule_update(
+            instance.products.values_list('id', flat=True))
+
+
+'''
+The following functions are used to invalidate the cached catalog when the rest of its data changes.
+'''
+
+
+@receiver(post_save, sender=models.ProductImage)
+@receiver(post_delete, sender=models.ProductImage)
+def product_image_changed(sender, instance: models.ProductImage, **kwargs):
+    invalidate_products([instance.product_id])
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=models.Image)
+@receiver(post_delete, sender=models.Image)
+def image_changed(sender, instance: models.Image, **kwargs):
+    invalidate_products(instance.products.values_list('id', flat=True))
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=models.Category)
+@receiver(post_delete, sender=models.Category)
+def catalog_changed(sender, **kwargs):
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=models.Wishlist)
+@receiver(post_delete, sender=models.Wishlist)
+def whishlist_changed(sender, instance: models.Wishlist, **kwargs):
+    invalidate_whishlist(instance.user_id)
+
+
+'''
+The following function is used to create the resized copies of an image when it is uploaded.
+'''
+
+
+@receiver(post_save, sender=models.Image)
+def image_process_post_save(sender, instance: models.Image, **kwargs):
+    images.schedule_processing(instance)
+
+
+'''
+The following function is used to create the cart of a user along with the user.
+'''
+
+
+@receiver(post_save, sender=models.User)
+def user_cart_post_save(sender, instance: models.User, created, **kwargs):
+    if created:
+        carts.ensure_cart(instance)
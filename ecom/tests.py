@@ -1,3 +1,812 @@
-from django.test import TestCase
+import base64
+import datetime
+import io
+import json
+import re
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future
+from unittest import mock
+from ecom import archive
+from ecom import cache as catalog_cache
+from ecom import carts
+from ecom import images
+from ecom import inventory
+from ecom import models
+from ecom import orders
+from ecom import search
+from ecom.api import pagination
+from ecom.utils import on_commit_batch
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from PIL import Image as PILImage
 
 # Create your tests here.
+
+
+class CartQueryCountTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        category = models.Category.objects.create(name='Category')
+        cart = models.Cart.objects.get(user=self.user)
+        for index in range(50):
+            product = models.Product.objects.create(
+                name=f'Product {index}', description='Description', category=category)
+            for sort_order in (1, 0):
+                image = models.Image.objects.create(
+                    name=f'Image {index}.{sort_order}', image=f'images/{index}-{sort_order}.jpg')
+                models.ProductImage.objects.create(
+                    product=product, image=image, sort_order=sort_order)
+            variant = models.ProductVariant.objects.create(
+                product=product, name='Variant', mrp=200, price=100, stock=10)
+            models.CartItem.objects.create(cart=cart, product_variant=variant, quantity=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_cart_list_query_count(self):
+        # The cart, its lines with their variants and products, and the
+        # first image of every product.
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/ecom/cart/')
+        self.assertEqual(response.status_code, 200)
+        products = response.json()['products']
+        self.assertEqual(len(products), 50)
+        self.assertEqual(response.json()['sub_total'], 50 * 2 * 100)
+        self.assertEqual(products[0]['image']['name'], 'Image 0.0')
+
+
+class OrderPlacementTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        self.category = models.Category.objects.create(name='Category')
+        self.cart = models.Cart.objects.get(user=self.user)
+        self.cart.address = models.Address.objects.create(
+            user=self.user, name='Name', address='Address', city='City', state='State',
+            pincode='000000', phone_number='+919999999999')
+        self.cart.coupon = models.Coupon.objects.create(
+            code='TEN', discount=10, coupon_type='percentage', quantity=5)
+        self.cart.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fill_cart(self, lines):
+        for index in range(lines):
+            product = models.Product.objects.create(
+                name=f'Product {index}', description='Description', category=self.category)
+            variant = models.ProductVariant.objects.create(
+                product=product, name='Variant', mrp=200, price=100, stock=10)
+            models.CartItem.objects.create(cart=self.cart, product_variant=variant, quantity=2)
+
+    def place_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/ecom/orders/')
+        self.assertEqual(response.status_code, 201)
+        return response.json(), len(queries)
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        self.fill_cart(1)
+        _, small = self.place_order()
+        self.fill_cart(20)
+        order, large = self.place_order()
+        self.assertEqual(small, large)
+        self.assertEqual(len(order['items']), 20)
+        self.assertEqual(
+            (order['sub_total'], order['discount'], order['coupon_code'], order['total']),
+            (4000, 400, 'TEN', 3600))
+        self.assertEqual(order['status'], 'Pending')
+        self.assertFalse(models.CartItem.objects.filter(cart=self.cart).exists())
+        self.assertEqual(
+            set(models.ProductVariant.objects.values_list('stock', flat=True)), {8})
+
+
+class OrderStatusChangeTest(TestCase):
+    def test_orders_only_move_forward(self):
+        User = get_user_model()
+        user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        order_ids = []
+        for status in (0, 0, 6, 4):
+            order = models.Order.objects.create(
+                user=user, name='Name', address='Address', city='City', state='State',
+                pincode='000000', phone_number='+919999999999')
+            models.OrderStatus.objects.create(order=order, status=status)
+            order_ids.append(order.pk)
+
+        with self.assertNumQueries(6):
+            changed, rejected = orders.change_status(order_ids + [0], 5)
+        self.assertEqual(changed, order_ids[:2])
+        self.assertEqual(rejected, {
+            order_ids[2]: 'Already Delivered', order_ids[3]: 'Already Cancelled',
+            0: 'Order not found'})
+        self.assertEqual(
+            list(models.Order.objects.filter(pk__in=order_ids).order_by('pk').values_list(
+                'status', flat=True)),
+            ['Despatched', 'Despatched', 'Delivered', 'Cancelled'])
+
+
+class OrderStatusActionTest(TestCase):
+    def test_cancelled_and_returned_orders_are_reported_apart(self):
+        User = get_user_model()
+        admin = User.objects.create_superuser(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        order_ids = []
+        for status in ('Paid', 'Delivered', 'Cancelled', 'Returned'):
+            order = models.Order.objects.create(
+                user=admin, name='Name', address='Address', city='City', state='State',
+                pincode='000000', phone_number='+919999999999')
+            models.OrderStatus.objects.create(
+                order=order, status=models.STATUS_CHOICES.index(status))
+            order_ids.append(order.pk)
+        self.client.force_login(admin)
+
+        response = self.client.post('/admin/ecom/order/', {
+            'action': 'mark_delivered', '_selected_action': order_ids}, follow=True)
+        self.assertEqual([str(message) for message in response.context['messages']], [
+            '1 orders marked as Delivered.',
+            '2 orders are cancelled or returned and cannot change status.',
+            '1 orders were left unchanged, being already Delivered or further along.',
+        ])
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        self.old = timezone.now() - datetime.timedelta(days=archive.get_archive_age() + 1)
+
+    def create_order(self, status, created_at=None):
+        order = models.Order.objects.create(
+            user=self.user, name='Name', address='Address', city='City', state='State',
+            pincode='000000', phone_number='+919999999999', total=100)
+        models.OrderStatus.objects.create(
+            order=order, status=models.STATUS_CHOICES.index(status))
+        models.Order.objects.filter(pk=order.pk).update(
+            created_at=created_at or self.old)
+        return order
+
+    def test_finished_old_orders_are_moved(self):
+        delivered = self.create_order('Delivered')
+        pending = self.create_order('Pending')
+        recent = self.create_order('Delivered', created_at=timezone.now())
+
+        self.assertEqual(archive.archive_orders(), 1)
+        self.assertEqual(
+            set(models.Order.objects.values_list('pk', flat=True)), {pending.pk, recent.pk})
+        self.assertFalse(models.OrderStatus.objects.filter(order_id=delivered.pk).exists())
+        archived = models.ArchivedOrder.objects.get()
+        self.assertEqual(
+            (archived.pk, archived.status, archived.data['status']),
+            (delivered.pk, 'Delivered', 'Delivered'))
+        self.assertEqual(archive.archive_orders(), 0)
+
+    def test_order_history_reads_through_to_the_archive(self):
+        for index in range(7):
+            self.create_order(
+                'Delivered' if index % 2 else 'Pending',
+                created_at=self.old - datetime.timedelta(days=index))
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        def history(params):
+            pages, url = [], '/api/ecom/orders/'
+            while url:
+                response = client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                pages.append([order['id'] for order in response.json()['results']])
+                url, params = response.json()['next'], None
+            return pages
+
+        params = [{}, {'pagination': 'cursor'}, {'count': 'false'}]
+        with mock.patch.object(pagination.KeysetPagination, 'page_size', 2):
+            before = [history(page_params) for page_params in params]
+            self.assertEqual(archive.archive_orders(), 3)
+            self.assertEqual(models.Order.objects.count(), 4)
+            self.assertEqual([history(page_params) for page_params in params], before)
+        self.assertEqual([len(page) for page in before[0]], [2, 2, 2, 1])
+
+        archived = models.ArchivedOrder.objects.first()
+        response = client.get(f'/api/ecom/orders/{archived.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'Delivered')
+
+    def test_order_history_pages_read_only_their_rows(self):
+        created = [
+            self.create_order('Pending', created_at=timezone.now() - datetime.timedelta(days=index))
+            for index in range(3)
+        ] + [
+            self.create_order('Delivered', created_at=self.old - datetime.timedelta(days=2 * index))
+            for index in range(4)
+        ]
+        # An unfinished order as old as the archived ones, merged with them.
+        created.insert(5, self.create_order(
+            'Pending', created_at=self.old - datetime.timedelta(days=3)))
+        self.assertEqual(archive.archive_orders(), 4)
+        ordering = ('-created_at', 'id')
+        history = archive.OrderHistory(
+            models.Order.objects.filter(user=self.user).order_by(*ordering),
+            models.ArchivedOrder.objects.filter(user=self.user).order_by(*ordering),
+            ordering)
+
+        pages = []
+        for start in range(0, 8, 2):
+            with CaptureQueriesContext(connection) as queries:
+                pages.append([order.pk for order in history[start:start + 2]])
+            # The page and the one old unfinished order at most.
+            self.assertTrue(all(
+                int(limit) <= 3 for query in queries
+                for limit in re.findall(r'LIMIT (\d+)', query['sql'])))
+        self.assertEqual(sum(pages, []), [order.pk for order in created])
+
+    def test_orders_whose_id_is_archived_are_kept(self):
+        order = self.create_order('Delivered')
+        models.ArchivedOrder.objects.create(
+            id=order.pk, user=self.user, created_at=self.old, status='Delivered')
+
+        self.assertEqual(archive.archive_orders(), 0)
+        self.assertTrue(models.Order.objects.filter(pk=order.pk).exists())
+        self.assertTrue(models.OrderStatus.objects.filter(order=order).exists())
+
+
+class KeysetPaginationTest(TestCase):
+    def cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps({'p': position, 'r': 0}).encode()).decode()
+
+    def test_cursors_with_values_of_the_wrong_type_are_not_found(self):
+        User = get_user_model()
+        user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        client = APIClient()
+        client.force_authenticate(user)
+        for url, position in [
+            ('/api/ecom/orders/', ['garbage', 1]),
+            ('/api/ecom/orders/', [None, 1]),
+            ('/api/ecom/products/', [{'a': 1}, 'x', 1]),
+            ('/api/ecom/products/', [True, 'x', 'y']),
+        ]:
+            response = client.get(url, {'cursor': self.cursor(position)})
+            self.assertEqual(response.status_code, 404, (url, position))
+            self.assertEqual(response.json()['detail'], 'Invalid cursor')
+
+
+class CartAdminTest(TestCase):
+    def test_changelist_sorts_on_annotated_totals(self):
+        User = get_user_model()
+        admin = User.objects.create_superuser(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Product', description='Description', category=category)
+        variant = models.ProductVariant.objects.create(
+            product=product, name='Variant', mrp=10, price=5, stock=10)
+        for index, quantity in enumerate([3, 0, 1]):
+            user = User.objects.create_user(
+                **{User.USERNAME_FIELD: f'+91999999990{index}'}, password=None)
+            if quantity:
+                models.CartItem.objects.create(
+                    cart=models.Cart.objects.get(user=user), product_variant=variant,
+                    quantity=quantity)
+        self.client.force_login(admin)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/ecom/cart/?o=-3')
+        changelist = response.context['cl']
+        self.assertEqual(
+            [cart.price for cart in changelist.result_list], [15, 5, 0, 0])
+        self.assertEqual(changelist.result_count, 4)
+        self.assertLessEqual(len(queries), 4)
+
+
+class CartLinesTest(TestCase):
+    def test_sync_lines_with_a_line_inserted_concurrently(self):
+        User = get_user_model()
+        user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Product', description='Description', category=category)
+        variant = models.ProductVariant.objects.create(
+            product=product, name='Variant', mrp=200, price=100, stock=10)
+        cart = models.Cart.objects.get(user=user)
+        # Read before another request added the same variant.
+        lines = {}
+        models.CartItem.objects.create(cart=cart, product_variant=variant, quantity=1)
+
+        carts.sync_lines(cart, {variant.pk: 3}, lines)
+        self.assertEqual(
+            list(models.CartItem.objects.filter(cart=cart).values_list('quantity', flat=True)),
+            [3])
+
+
+class CartLineUpdateTest(TestCase):
+    def setUp(self):
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Product', description='Description', category=category)
+        self.variants = [
+            models.ProductVariant.objects.create(
+                product=product, name=name, mrp=200, price=100, stock=10)
+            for name in ('S', 'M')
+        ]
+
+    def test_moving_a_line_to_a_variant_in_the_cart_merges_them(self):
+        User = get_user_model()
+        user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        cart = models.Cart.objects.get(user=user)
+        small, medium = self.variants
+        models.CartItem.objects.create(cart=cart, product_variant=small, quantity=2)
+        models.CartItem.objects.create(cart=cart, product_variant=medium, quantity=1)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.put(
+            f'/api/ecom/cart/{small.pk}/', {'product_variant': medium.pk, 'quantity': 2},
+            format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(models.CartItem.objects.filter(cart=cart).values_list(
+                'product_variant_id', 'quantity')),
+            [(medium.pk, 3)])
+
+    def test_moving_a_guest_line_to_a_variant_in_the_cart_merges_them(self):
+        small, medium = self.variants
+        client = APIClient()
+        response = client.post(
+            '/api/ecom/cart/', {'product_variant': small.pk, 'quantity': 2}, format='json')
+        token = response.headers['X-Cart-Token']
+        client.post(
+            '/api/ecom/cart/', {'product_variant': medium.pk}, format='json',
+            HTTP_X_CART_TOKEN=token)
+
+        response = client.patch(
+            f'/api/ecom/cart/{small.pk}/', {'product_variant': medium.pk}, format='json',
+            HTTP_X_CART_TOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        guest = carts.GuestCart.load(signing.loads(token, salt=carts.GUEST_CART_SALT))
+        self.assertEqual(guest.items, {medium.pk: 3})
+
+
+class PythonSearchBackendTest(TestCase):
+    def test_other_processes_reread_only_the_changed_documents(self):
+        cache.delete(search.PythonSearchBackend.version_key)
+        category = models.Category.objects.create(name='Category')
+        products = [
+            models.Product.objects.create(name=name, description='Description', category=category)
+            for name in ('Red Saree', 'Blue Shirt')
+        ]
+        documents = [search.build_document(product) for product in products]
+        models.ProductSearchDocument.objects.bulk_create(documents)
+        ours, theirs = search.PythonSearchBackend(), search.PythonSearchBackend()
+        ours.index(documents)
+        self.assertEqual(theirs.search('red'), [products[0].pk])
+
+        products[1].name = 'Red Shirt'
+        document = search.build_document(products[1])
+        document.save()
+        ours.index([document])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(theirs.search('red'), [products[0].pk, products[1].pk])
+        self.assertEqual(len(queries), 1)
+        self.assertIn('WHERE', queries[0]['sql'])
+
+
+class ReindexProductsTest(TestCase):
+    def test_create_index_indexes_the_existing_products(self):
+        backend = search.SqliteSearchBackend()
+        if connection.vendor != 'sqlite' or type(search.create_backend()) is not type(backend):
+            self.skipTest('SQLite without FTS5')
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Red Saree', description='Description', category=category)
+        with mock.patch.object(search, '_backend', backend):
+            self.assertIsNone(search.search_products('saree'))
+            call_command('reindexproducts', '--create-index', stdout=io.StringIO())
+            self.assertEqual(search.search_products('saree'), [product.pk])
+
+
+class ProductSearchFallbackTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = models.Category.objects.create(name='Category')
+        for name in ('Red Saree', 'Blue Saree', 'Silk Saree', 'Shirt'):
+            product = models.Product.objects.create(
+                name=name, description='Description', category=category)
+            models.ProductVariant.objects.create(
+                product=product, name='Variant', mrp=200, price=100, stock=10)
+        self.backend = mock.patch.object(search, '_backend', search.SqliteSearchBackend())
+        self.backend.start()
+        self.addCleanup(self.backend.stop)
+
+    def test_facets_count_every_match(self):
+        response = APIClient().get('/api/ecom/products/', {'search': 'saree', 'facets': 'true'})
+        self.assertEqual(response.data['facets']['categories'][0]['count'], 3)
+        self.assertEqual(response.data['facets']['in_stock'], {'true': 3, 'false': 0})
+
+    def test_searching_without_facets_does_not_list_the_matches(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get('/api/ecom/products/', {'search': 'saree'})
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertFalse([
+            query for query in queries
+            if query['sql'].startswith('SELECT "ecom_product"."id" AS "pk" FROM')])
+
+
+class GuestCartTest(TestCase):
+    def setUp(self):
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Product', description='Description', category=category)
+        self.variant = models.ProductVariant.objects.create(
+            product=product, name='Variant', mrp=200, price=100, stock=10)
+
+    def lines(self, token):
+        return list(models.CartItem.objects.filter(
+            cart__guest_token=token).values_list('product_variant_id', 'quantity'))
+
+    def test_changes_are_written_right_away_without_a_cart_cache(self):
+        guest = carts.GuestCart(uuid.uuid4().hex)
+        guest.apply([{'op': 'add', 'product_variant': self.variant.pk, 'quantity': 2}])
+        guest.save()
+        self.assertEqual(self.lines(guest.token), [(self.variant.pk, 2)])
+        self.assertIsNone(cache.get(guest.key))
+        self.assertEqual(carts.GuestCart.load(guest.token).items, {self.variant.pk: 2})
+
+    @override_settings(ECOM_GUEST_CART_CACHE='default')
+    def test_changes_are_written_by_persist_pending(self):
+        guest = carts.GuestCart(uuid.uuid4().hex)
+        for _ in range(3):
+            guest.apply([{'op': 'add', 'product_variant': self.variant.pk}])
+            guest.save()
+        self.assertEqual(self.lines(guest.token), [])
+        self.assertEqual(carts.persist_pending(before=timezone.now() - datetime.timedelta(
+            seconds=carts.get_write_delay())), 0)
+
+        self.assertEqual(carts.persist_pending(before=timezone.now()), 1)
+        self.assertEqual(self.lines(guest.token), [(self.variant.pk, 3)])
+        # A change after the write marks the cart again.
+        guest.apply([{'op': 'remove', 'product_variant': self.variant.pk}])
+        guest.save()
+        self.assertEqual(carts.persist_pending(before=timezone.now()), 1)
+        self.assertEqual(self.lines(guest.token), [])
+
+    def test_cross_origin_clients_can_use_the_token_header(self):
+        client = APIClient()
+        response = client.options(
+            '/api/ecom/cart/', HTTP_ORIGIN='https://example.com',
+            HTTP_ACCESS_CONTROL_REQUEST_METHOD='POST',
+            HTTP_ACCESS_CONTROL_REQUEST_HEADERS='x-cart-token')
+        self.assertIn('x-cart-token', response.headers['Access-Control-Allow-Headers'])
+        response = client.get('/api/ecom/cart/', HTTP_ORIGIN='https://example.com')
+        self.assertIn(carts.GUEST_CART_HEADER, response.headers['Access-Control-Expose-Headers'])
+
+    @override_settings(ECOM_GUEST_CART_CACHE='default')
+    def test_expired_guest_carts_are_purged(self):
+        guest = carts.GuestCart(uuid.uuid4().hex, {self.variant.pk: 1})
+        guest.save()
+        carts.persist_pending(before=timezone.now())
+        active = carts.GuestCart(uuid.uuid4().hex, {self.variant.pk: 1})
+        active.save()
+        later = timezone.now() + datetime.timedelta(seconds=carts.GUEST_CART_TIMEOUT + 1)
+
+        self.assertEqual(carts.purge_guest_carts(), 0)
+        self.assertEqual(carts.purge_guest_carts(before=later), 1)
+        self.assertFalse(models.Cart.objects.filter(guest_token=guest.token).exists())
+        self.assertFalse(models.CartItem.objects.filter(cart__guest_token=guest.token).exists())
+        # Carts with changes still to write are kept.
+        self.assertTrue(models.Cart.objects.filter(guest_token=active.token).exists())
+
+
+class ImageProcessingTest(TestCase):
+    def test_callback_run_inline_keeps_the_connection(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            PILImage.new('RGB', (20, 10)).save(f'{media_root}/a.jpg')
+            image = models.Image.objects.create(name='Image', image='a.jpg')
+            # A pool that has already rendered the image when the callback
+            # is added, which then runs in this thread.
+            rendered = Future()
+            rendered.set_result(images.render_derivatives(images.read_image(image)))
+            with mock.patch.object(images, 'get_worker_count', return_value=1), \
+                    mock.patch.object(images, 'get_executor') as get_executor, \
+                    mock.patch.object(images.connections, 'close_all') as close_all:
+                get_executor.return_value.submit.return_value = rendered
+                self.assertTrue(images.process_image(image, force=True))
+            self.assertFalse(close_all.called)
+            image.refresh_from_db()
+            self.assertEqual(set(image.derivatives), set(images.IMAGE_SIZES))
+
+
+class OnCommitBatchTest(TestCase):
+    def test_rolled_back_items_are_dropped(self):
+        calls = []
+
+        def handler(items):
+            calls.append(items)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                on_commit_batch(handler, [1])
+                raise RuntimeError
+            with transaction.atomic():
+                on_commit_batch(handler, [2])
+                on_commit_batch(handler, [3])
+        self.assertEqual(calls, [{2, 3}])
+
+
+class CatalogVersionTest(TestCase):
+    def test_saving_many_rows_bumps_the_version_once(self):
+        bump = mock.Mock(wraps=catalog_cache.bump_version)
+        with mock.patch.object(catalog_cache, 'bump_version', bump):
+            with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                category = models.Category.objects.create(name='Category')
+                for index in range(3):
+                    models.Product.objects.create(
+                        name=f'Product {index}', description='Description', category=category)
+        self.assertEqual(
+            [call for call in bump.call_args_list
+             if call.args == (catalog_cache.CATALOG_VERSION_KEY,)],
+            [mock.call(catalog_cache.CATALOG_VERSION_KEY)])
+
+
+class CatalogConditionalTest(TestCase):
+    def test_only_the_etag_is_validated(self):
+        client = APIClient()
+        response = client.get('/api/ecom/categories/')
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        self.assertEqual(
+            client.get('/api/ecom/categories/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # The catalog may have changed within the second of Last-Modified.
+        self.assertEqual(client.get(
+            '/api/ecom/categories/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+
+class CartResolutionConcurrencyTest(TransactionTestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        # A user from before carts were created along with the user.
+        models.Cart.objects.filter(user=self.user).delete()
+
+    def test_cart_created_by_a_concurrent_request(self):
+        raced = []
+
+        def create_concurrently(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if not raced and sql.startswith('SELECT') and 'ecom_cart' in sql:
+                raced.append(sql)
+                # Another request inserts the cart between our lookup and insert.
+                models.Cart.objects.bulk_create([models.Cart(user=self.user)])
+            return result
+
+        with connection.execute_wrapper(create_concurrently):
+            cart = carts.ensure_cart(self.user)
+        self.assertTrue(raced)
+        self.assertEqual(cart, models.Cart.objects.get(user=self.user))
+
+    # Threads cannot share the in-memory SQLite test database, so this only
+    # runs on MySQL; test_cart_created_by_a_concurrent_request covers the
+    # race on a single connection.
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    def test_parallel_first_requests_share_one_cart(self):
+        requests = 8
+        barrier = threading.Barrier(requests)
+        responses = []
+
+        def first_request():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                responses.append(client.get('/api/ecom/cart/').status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=first_request) for _ in range(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses, [200] * requests)
+        self.assertEqual(models.Cart.objects.filter(user=self.user).count(), 1)
+
+
+class StockReservationTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        # Runs the commit hooks, as if the catalog had been committed.
+        with self.captureOnCommitCallbacks(execute=True):
+            category = models.Category.objects.create(name='Category')
+            product = models.Product.objects.create(
+                name='Product', description='Description', category=category)
+            self.variants = [
+                models.ProductVariant.objects.create(
+                    product=product, name=f'Variant {index}', mrp=200, price=100, stock=5)
+                for index in range(2)
+            ]
+
+    def create_order(self):
+        order = models.Order.objects.create(
+            user=self.user, name='Name', address='Address', city='City', state='State',
+            pincode='000000', phone_number='+919999999999')
+        models.OrderStatus.objects.create(order=order, status=inventory.PENDING)
+        return order
+
+    def place_order(self, quantities):
+        order = self.create_order()
+        inventory.reserve(order, {
+            self.variants[index].pk: quantity for index, quantity in quantities.items()})
+        return order
+
+    def stock(self):
+        return [variant.stock for variant in models.ProductVariant.objects.order_by('pk')]
+
+    def test_reserve_takes_all_or_nothing(self):
+        self.place_order({0: 3, 1: 5})
+        self.assertEqual(self.stock(), [2, 0])
+        with self.assertRaises(inventory.OutOfStock) as error:
+            self.place_order({0: 2, 1: 1})
+        self.assertEqual(error.exception.variant_ids, [self.variants[1].pk])
+        self.assertEqual(self.stock(), [2, 0])
+
+    def test_reserve_interleaved_with_another_takes_nothing(self):
+        first, second = self.create_order(), self.create_order()
+        raced = []
+
+        def reserve_concurrently(execute, sql, params, many, context):
+            if raced or not sql.startswith('UPDATE "ecom_productvariant"'):
+                return execute(sql, params, many, context)
+            raced.append(sql)
+            # The second order takes one of the variants after the first has
+            # locked them, before its conditional update. Both run in one
+            # transaction here, so the stock is checked in between.
+            inventory.reserve(second, {self.variants[1].pk: 1})
+            result = execute(sql, params, many, context)
+            raced.append(self.stock())
+            return result
+
+        with connection.execute_wrapper(reserve_concurrently), \
+                self.assertRaises(inventory.OutOfStock):
+            inventory.reserve(first, {self.variants[0].pk: 3, self.variants[1].pk: 5})
+        # The update took the first variant only, which would be -1 otherwise.
+        self.assertEqual(raced[1], [2, 4])
+        self.assertFalse(models.StockReservation.objects.filter(order=first).exists())
+        self.assertEqual(self.stock(), [5, 5])
+
+    def test_cancelling_releases_stock_once(self):
+        order = self.place_order({0: 3})
+        models.OrderStatus.objects.create(order=order, status=inventory.PAID)
+        models.OrderStatus.objects.create(order=order, status=inventory.CANCELLED)
+        models.OrderStatus.objects.create(order=order, status=inventory.RELEASING_STATUSES[1])
+        self.assertEqual(self.stock(), [5, 5])
+
+    def test_expired_reservations_cancel_unpaid_orders(self):
+        unpaid = self.place_order({0: 2})
+        paid = self.place_order({0: 1})
+        models.OrderStatus.objects.create(order=paid, status=inventory.PAID)
+        later = timezone.now() + datetime.timedelta(
+            seconds=inventory.get_reservation_timeout() + 1)
+        self.assertEqual(inventory.expire_reservations(now=later), [unpaid.pk])
+        self.assertEqual(self.stock(), [4, 5])
+        unpaid.refresh_from_db()
+        self.assertEqual(unpaid.status, 'Cancelled')
+
+    def test_selling_out_changes_only_what_depends_on_the_stock(self):
+        client = APIClient()
+        urls = [
+            '/api/ecom/products/', '/api/ecom/categories/',
+            '/api/ecom/products/?in_stock=true', '/api/ecom/products/?facets=true',
+        ]
+        etags = [client.get(url).headers['ETag'] for url in urls]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place_order({0: 5, 1: 5})
+        self.assertEqual(self.stock(), [0, 0])
+        responses = [
+            client.get(url, HTTP_IF_NONE_MATCH=etag) for url, etag in zip(urls, etags)]
+        self.assertEqual([response.status_code for response in responses], [304, 304, 200, 200])
+        self.assertEqual(responses[2].json()['results'], [])
+        self.assertEqual(responses[3].json()['facets']['in_stock'], {'true': 0, 'false': 1})
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    def test_checkout_interleaved_with_another_does_not_oversell(self):
+        User = get_user_model()
+        user = User.objects.create_user(
+            **{User.USERNAME_FIELD: '+919999999999'}, password='password')
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Product', description='Description', category=category)
+        variant = models.ProductVariant.objects.create(
+            product=product, name='Variant', mrp=200, price=100, stock=1)
+        cart = models.Cart.objects.get(user=user)
+        cart.address = models.Address.objects.create(
+            user=user, name='Name', address='Address', city='City', state='State',
+            pincode='000000', phone_number='+919999999999')
+        cart.save()
+        models.CartItem.objects.create(cart=cart, product_variant=variant, quantity=1)
+        other = models.Order.objects.create(
+            user=user, name='Name', address='Address', city='City', state='State',
+            pincode='000000', phone_number='+919999999999')
+        raced = []
+
+        def checkout_concurrently(execute, sql, params, many, context):
+            if raced or not sql.startswith('UPDATE "ecom_productvariant"'):
+                return execute(sql, params, many, context)
+            raced.append(sql)
+            # Another checkout takes the last one after this one has read
+            # the cart and locked the variant, before it updates the stock.
+            # It runs in the same transaction here, so it is rolled back
+            # along with this one, and the stock is checked in between.
+            inventory.reserve(other, {variant.pk: 1})
+            result = execute(sql, params, many, context)
+            raced.append(models.ProductVariant.objects.get(pk=variant.pk).stock)
+            return result
+
+        client = APIClient()
+        client.force_authenticate(user)
+        with connection.execute_wrapper(checkout_concurrently):
+            response = client.post('/api/ecom/orders/')
+        self.assertEqual(response.status_code, 400)
+        # The stock after both checkouts, which would be -1 if both took it.
+        self.assertEqual(raced[1], 0)
+        self.assertEqual(list(models.Order.objects.values_list('pk', flat=True)), [other.pk])
+        self.assertTrue(models.CartItem.objects.filter(cart=cart).exists())
+
+    # Only runs on MySQL, like test_parallel_first_requests_share_one_cart;
+    # the interleaved tests here and in StockReservationTest cover the race
+    # on a single connection.
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    def test_parallel_checkouts_do_not_oversell(self):
+        User = get_user_model()
+        category = models.Category.objects.create(name='Category')
+        product = models.Product.objects.create(
+            name='Product', description='Description', category=category)
+        variant = models.ProductVariant.objects.create(
+            product=product, name='Variant', mrp=200, price=100, stock=3)
+        users = []
+        for index in range(8):
+            phone_number = f'+91999999990{index}'
+            user = User.objects.create_user(**{User.USERNAME_FIELD: phone_number}, password=None)
+            cart = models.Cart.objects.get(user=user)
+            cart.address = models.Address.objects.create(
+                user=user, name='Name', address='Address', city='City', state='State',
+                pincode='000000', phone_number=phone_number)
+            cart.save()
+            models.CartItem.objects.create(cart=cart, product_variant=variant, quantity=1)
+            users.append(user)
+        barrier = threading.Barrier(len(users))
+        responses = []
+
+        def checkout(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                barrier.wait()
+                responses.append(client.post('/api/ecom/orders/').status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=[user]) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        variant.refresh_from_db()
+        self.assertEqual(sorted(responses), [201] * 3 + [400] * 5)
+        self.assertEqual(variant.stock, 0)
@@ -1,36 +1,128 @@
+import threading
+from django.db import transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from rest_framework.serializers import ValidationError
 
+_batches = threading.local()
 
-def validate_coupon(cart, coupon=None):
-    if not coupon:
-        if cart.coupon:
-            coupon = cart.coupon
-        else:
+
+def on_commit_batch(handler, items):
+    '''
+    Collects items for handler during the current transaction and calls
+    handler once with all of them when it commits, rather than once per
+    call. Outside of a transaction handler is called right away.
+    '''
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        items = set(items)
+        if items:
+            handler(items)
+        return
+    batches = _batches.__dict__.setdefault('pending', {})
+    batch = batches.get(handler)
+    # The connection starts a new list of commit hooks when a transaction
+    # commits or rolls back, and when a savepoint is rolled back. A batch
+    # registered with another list belongs to a transaction that has ended
+    # (its items are dropped along with its hook on rollback) or may have
+    # lost its hook, so a new one is started.
+    if batch is None or batch[0] is not connection.run_on_commit:
+        batch = batches[handler] = (connection.run_on_commit, set())
+        transaction.on_commit(lambda: flush_batch(handler, batch))
+    batch[1].update(items)
+
+
+def flush_batch(handler, batch):
+    batches = _batches.__dict__.get('pending', {})
+    if batches.get(handler) is batch:
+        del batches[handler]
+    if batch[1]:
+        handler(batch[1])
+
+
+class CartPricing:
+    '''
+    The prices of a cart, computed once from its lines.
+
+    The lines are read through cart.cartitem_set.all(), so a cart loaded
+    with Cart.objects.for_pricing() is priced without further queries.
+    Carts that are not stored in the database (guest carts) pass their
+    lines as items instead.
+    '''
+
+    def __init__(self, cart, items=None):
+        self.cart = cart
+        self.coupon = cart.coupon
+        if items is not None:
+            self.items = list(items)
+
+    @cached_property
+    def items(self):
+        return list(self.cart.cartitem_set.all())
+
+    @cached_property
+    def sub_total(self):
+        return round(sum(
+            item.product_variant.price * item.quantity for item in self.items), 2)
+
+    def validate_coupon(self, coupon=None):
+        coupon = coupon or self.coupon
+        if not coupon:
             raise ValidationError('Invalid coupon')
-    if not coupon.active or (coupon.quantity and coupon.quantity <= 0):
-        raise ValidationError('Coupon is not available')
-    if coupon.valid_from and coupon.valid_from > timezone.now():
-        raise ValidationError('Coupon is not available yet')
-    if coupon.valid_to and coupon.valid_to < timezone.now():
-        raise ValidationError('Coupon has expired')
-    if coupon.minimum_order_value and cart.sub_total < coupon.minimum_order_value:
-        raise ValidationError(
-            f"Minimum order value should be {coupon.minimum_order_value}")
-    return coupon.code
+        if not coupon.active or (coupon.quantity and coupon.quantity <= 0):
+            raise ValidationError('Coupon is not available')
+        if coupon.valid_from and coupon.valid_from > timezone.now():
+            raise ValidationError('Coupon is not available yet')
+        if coupon.valid_to and coupon.valid_to < timezone.now():
+            raise ValidationError('Coupon has expired')
+        if coupon.minimum_order_value and self.sub_total < coupon.minimum_order_value:
+            raise ValidationError(
+                f"Minimum order value should be {coupon.minimum_order_value}")
+        return coupon.code
 
+    @cached_property
+    def discount(self):
+        if not self.coupon:
+            return 0
+        try:
+            self.validate_coupon()
+        except ValidationError:
+            return 0
+        if self.coupon.coupon_type == 'percentage':
+            return round(self.sub_total * self.coupon.discount / 100, 2)
+        return round(
+            self.coupon.discount if self.sub_total - self.coupon.discount > 0 else 1, 2)
 
-def calculate_discount(cart):
-    try:
-        if cart.coupon and validate_coupon(cart):
-            if cart.coupon.coupon_type == 'percentage':
-                return round(cart.sub_total * cart.coupon.discount / 100, 2)
-            return round(
-                cart.coupon.discount if cart.sub_total - cart.coupon.discount > 0 else 1, 2)
+    @cached_property
+    def shipping(self):
         return 0
-    except ValidationError:
+
+    @cached_property
+    def tax(self):
         return 0
 
+    @cached_property
+    def total(self):
+        return round(self.sub_total - self.discount + self.shipping + self.tax, 2)
+
+
+def get_pricing(cart):
+    '''
+    The CartPricing of a cart instance, created on first use and kept on the
+    instance, so the serializer fields and views share one computation.
+    '''
+    if getattr(cart, '_pricing', None) is None:
+        cart._pricing = CartPricing(cart)
+    return cart._pricing
+
+
+def validate_coupon(cart, coupon=None):
+    return get_pricing(cart).validate_coupon(coupon)
+
+
+def calculate_discount(cart):
+    return get_pricing(cart).discount
+
 
 def calculate_payment_fee(order_amount):
     pg_charge = 2 / 100  # 2% payment gateway charge
@@ -40,15 +132,15 @@ def calculate_payment_fee(order_amount):
 
 
 def calculate_shipping(cart):
-    return 0
+    return get_pricing(cart).shipping
 
 
 def calculate_tax(cart):
-    return 0
+    return get_pricing(cart).tax
 
 
 def calculate_total(cart):
-    return round(cart.sub_total - calculate_discount(cart) + calculate_shipping(cart) + calculate_tax(cart), 2)
+    return get_pricing(cart).total
 
 
 PAYMENT_MODES = [
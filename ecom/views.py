@@ -1,21 +1,31 @@
-import json
 from . import models
-from .api.views import CategoryProductViewSet, ProductViewSet
-from django.shortcuts import render
+from .cache import catalog_version, product_versions, CATALOG_SNAPSHOT_TIMEOUT
+from .api.views import CategoryProductViewSet
+from .api.serializers import ProductSerializer
+from django.shortcuts import get_object_or_404, render
 
 # Create your views here.
 
 
 def category_products_view(request):
-    viewset = CategoryProductViewSet()
-    viewset.request = request
-    res = viewset.list(request).data
-    data = json.loads(json.dumps(res))
+    def data():
+        # Only evaluated by the template when its cached fragment is stale.
+        viewset = CategoryProductViewSet(request=request)
+        categories = viewset.list_snapshot(request).data
+        versions = product_versions(
+            product['id'] for category in categories for product in category['products'])
+        for category in categories:
+            for product in category['products']:
+                product['version'] = versions[product['id']]
+        return categories
+
     return render(
         request,
         'ecom/category-products.dhtml',
         context={
-            'data': data
+            'data': data,
+            'catalog_version': catalog_version(),
+            'cache_timeout': CATALOG_SNAPSHOT_TIMEOUT,
         }
     )
 
@@ -28,13 +38,10 @@ def products_view(request):
     )
 
 
-def product_detail(request):
-    viewset = ProductViewSet()
-    viewset.request = request
-    request.query_params = {}
-    viewset.kwargs = {'pk': 1}
-    res = viewset.retrieve(request).data
-    data = json.loads(json.dumps(res))
+def product_detail(request, pk):
+    product = get_object_or_404(
+        models.Product.objects.for_catalog(request.user), pk=pk)
+    data = ProductSerializer(product, context={'request': request}).data
     return render(
         request,
         'ecom/product-detail.dhtml',
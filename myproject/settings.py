@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 import os
 import datetime
 from pathlib import Path
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -35,6 +36,11 @@ CORS_URLS_REGEX = r".*/api/.*$"
 
 CORS_ALLOW_ALL_ORIGINS = True
 
+# The guest cart token is sent and read as a header, see ecom.carts.
+CORS_ALLOW_HEADERS = (*default_headers, 'x-cart-token')
+
+CORS_EXPOSE_HEADERS = ['X-Cart-Token']
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -112,6 +118,30 @@ else:
         }
     }
 
+if DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {
+                'MAX_ENTRIES': 50000,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache'),
+            'OPTIONS': {
+                'MAX_ENTRIES': 50000,
+            },
+        }
+    }
+
+# Guest carts are written to the database on every change. To write them
+# behind, set ECOM_GUEST_CART_CACHE to the alias of a cache that does not
+# evict them, like Redis; the file based cache culls entries at random.
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 24,